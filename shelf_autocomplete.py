@@ -0,0 +1,237 @@
+# Import libraries
+import sqlite3
+import sys
+import time
+import unicodedata
+from bisect import bisect_left, bisect_right
+
+from shelf_queries import SQL
+
+# =========================================================================
+# Prefix autocomplete for author names and book titles
+#
+# PrefixIndex keeps the folded (case-folded, accents and punctuation
+# removed) author names and titles in sorted lists, so the matches for a
+# typed prefix are one binary search away. Each name is indexed under the
+# whole string and under every word in it, so 'tolk' finds J.R.R. Tolkien
+# as well as 'j r r'. Whole-string matches are listed first.
+#
+# Writes made through the same connection are applied to the index with
+# add() and remove(), which insert and delete keys in the sorted lists.
+# Commits by other connections are noticed through PRAGMA data_version,
+# and the index is then rebuilt on the next lookup.
+#
+# Try it against a database:
+#     python shelf_autocomplete.py ebookstore.db tolk
+
+AUTHOR = 'author'
+TITLE = 'title'
+
+DEFAULT_LIMIT = 10
+
+
+def fold(text):
+    '''
+    This function returns the search key for a name or title: accents
+    are removed, case is folded and any run of punctuation or spaces
+    becomes a single space. 'Brontë' and 'BRONTE' both fold to 'bronte'.
+    '''
+    decomposed = unicodedata.normalize('NFKD', text)
+    chars = []
+    for char in decomposed:
+        if unicodedata.combining(char):
+            continue  # drop accents
+        chars.append(char if char.isalnum() else ' ')
+    return ' '.join(''.join(chars).casefold().split())
+
+
+def data_version(db):
+    '''
+    This function returns PRAGMA data_version, which changes when another
+    connection commits to the database.
+    '''
+    cursor = sqlite3.Connection.cursor(db)
+    cursor.row_factory = None
+    cursor.execute('PRAGMA data_version')
+    version = cursor.fetchone()[0]
+    cursor.close()
+    return version
+
+
+def _search_keys(name):
+    '''
+    This function returns the whole search key of a name and the key
+    again from the start of each later word.
+    '''
+    key = fold(name)
+    words = []
+    start = key.find(' ')
+    while start != -1:
+        words.append(key[start + 1:])
+        start = key.find(' ', start + 1)
+    return key, words
+
+
+def _insert_key(keys, ids, key, record_id):
+    # Keep entries in (key, id) order, as sorted by _SortedKeys()
+    i = bisect_left(keys, key)
+    end = bisect_right(keys, key, i)
+    while i < end and ids[i] < record_id:
+        i += 1
+    keys.insert(i, key)
+    ids.insert(i, record_id)
+
+
+def _delete_key(keys, ids, key, record_id):
+    i = bisect_left(keys, key)
+    while i < len(keys) and keys[i] == key:
+        if ids[i] == record_id:
+            del keys[i]
+            del ids[i]
+            return
+        i += 1
+
+
+class _SortedKeys:
+    '''
+    This class holds the sorted search keys for one kind of record, with
+    the record id of each key in a parallel list.
+    '''
+
+    def __init__(self, rows):
+        whole = []
+        words = []
+        self.names = {}
+        for record_id, name in rows:
+            if name is None:
+                continue
+            self.names[record_id] = name
+            key, word_keys = _search_keys(name)
+            whole.append((key, record_id))
+            words.extend((word, record_id) for word in word_keys)
+        whole.sort()
+        words.sort()
+        self.whole_keys = [key for key, _ in whole]
+        self.whole_ids = [record_id for _, record_id in whole]
+        self.word_keys = [key for key, _ in words]
+        self.word_ids = [record_id for _, record_id in words]
+
+    def add(self, record_id, name):
+        self.remove(record_id)
+        if name is None:
+            return
+        self.names[record_id] = name
+        key, word_keys = _search_keys(name)
+        _insert_key(self.whole_keys, self.whole_ids, key, record_id)
+        for word in word_keys:
+            _insert_key(self.word_keys, self.word_ids, word, record_id)
+
+    def remove(self, record_id):
+        name = self.names.pop(record_id, None)
+        if name is None:
+            return
+        key, word_keys = _search_keys(name)
+        _delete_key(self.whole_keys, self.whole_ids, key, record_id)
+        for word in word_keys:
+            _delete_key(self.word_keys, self.word_ids, word, record_id)
+
+    def complete(self, prefix, limit):
+        found = {}
+        for keys, ids in ((self.whole_keys, self.whole_ids),
+                          (self.word_keys, self.word_ids)):
+            i = bisect_left(keys, prefix)
+            while (i < len(keys) and len(found) < limit
+                   and keys[i].startswith(prefix)):
+                record_id = ids[i]
+                if record_id not in found:
+                    found[record_id] = self.names[record_id]
+                i += 1
+        return list(found.items())
+
+
+class PrefixIndex:
+    '''
+    This class answers autocomplete lookups for author names and book
+    titles in one database connection.
+    '''
+
+    def __init__(self, db):
+        self.db = db
+        self._indexes = {}
+        self._version = None
+
+    def _index(self, kind):
+        version = data_version(self.db)
+        if version != self._version:
+            # Another connection has written to the database
+            self._indexes = {}
+            self._version = version
+        index = self._indexes.get(kind)
+        if index is None:
+            cursor = self.db.cursor()
+            cursor.row_factory = None
+            cursor.execute(SQL['author_names'] if kind == AUTHOR
+                           else SQL['book_titles'])
+            index = _SortedKeys(cursor.fetchall())
+            cursor.close()
+            self._indexes[kind] = index
+        return index
+
+    def complete(self, prefix, kind=AUTHOR, limit=DEFAULT_LIMIT):
+        '''
+        This function returns up to limit (id, name) pairs of the authors
+        (kind=AUTHOR) or books (kind=TITLE) whose name or title, or a
+        word in it, starts with prefix.
+        '''
+        key = fold(prefix)
+        if not key:
+            return []
+        return self._index(kind).complete(key, limit)
+
+    def add(self, kind, record_id, name):
+        '''
+        This function adds or renames an author (kind=AUTHOR) or book
+        (kind=TITLE) written through this connection.
+        '''
+        index = self._indexes.get(kind)
+        if index is not None:
+            index.add(record_id, name)
+
+    def remove(self, kind, record_id):
+        '''
+        This function removes an author or book deleted through this
+        connection.
+        '''
+        index = self._indexes.get(kind)
+        if index is not None:
+            index.remove(record_id)
+
+    def complete_authors(self, prefix, limit=DEFAULT_LIMIT):
+        return self.complete(prefix, AUTHOR, limit)
+
+    def complete_titles(self, prefix, limit=DEFAULT_LIMIT):
+        return self.complete(prefix, TITLE, limit)
+
+
+def main(argv):
+    if len(argv) < 3:
+        print("Usage: python shelf_autocomplete.py DATABASE PREFIX")
+        return 1
+    db = sqlite3.connect(argv[1])
+    index = PrefixIndex(db)
+    prefix = ' '.join(argv[2:])
+    for kind in (AUTHOR, TITLE):
+        index.complete(prefix, kind)  # build the index
+        start = time.perf_counter()
+        matches = index.complete(prefix, kind)
+        elapsed = time.perf_counter() - start
+        print(f"{kind} matches for '{prefix}' "
+              f"({elapsed * 1000:.3f} ms):")
+        for record_id, name in matches:
+            print(f"  {record_id} : {name}")
+    db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,346 @@
+# Import libraries
+import argparse
+import csv
+import re
+import sqlite3
+import time
+import zlib
+from itertools import combinations
+
+from shelf_autocomplete import data_version, fold
+from shelf_queries import SQL
+
+# =========================================================================
+# Near-duplicate detection for titles and author names
+#
+# Supplier feeds bring variants such as 'Lord of the Rings, The' next to
+# 'The Lord of the Rings', or 'J. R. R. Tolkien' next to 'J.R.R. Tolkien'.
+# Names are first normalised (see normalise_title and normalise_author),
+# which makes most variants identical. Remaining near-duplicates are
+# found with MinHash locality-sensitive hashing over character 3-grams:
+# only records that share a band of their MinHash signature are compared,
+# so the whole catalog is checked without comparing every pair.
+#
+# Write a reviewable report of candidate pairs:
+#     python shelf_dedup.py ebookstore.db --kind author --report dupes.csv
+
+TITLE = 'title'
+AUTHOR = 'author'
+
+# Pairs below this 3-gram Jaccard similarity are not reported
+DEFAULT_THRESHOLD = 0.6
+
+# MinHash signature: BANDS bands of ROWS hashes each. Two records become
+# candidates if any band matches, which is likely from a similarity of
+# about (1 / BANDS) ** (1 / ROWS) = 0.44 upwards.
+BANDS = 12
+ROWS = 3
+
+# LSH buckets larger than this are made of very common 3-grams and are
+# not compared pair by pair
+MAX_BUCKET = 100
+
+_MASK = (1 << 32) - 1
+# Odd multipliers and offsets of the hash permutations, fixed so that
+# results are the same on every run
+_PERMUTATIONS = [((0x9E3779B1 * (2 * i + 1)) & _MASK | 1,
+                  (0x85EBCA6B * (i + 7)) & _MASK)
+                 for i in range(BANDS * ROWS)]
+
+_TRAILING_ARTICLE_RE = re.compile(r',\s*(the|a|an)\s*$', re.IGNORECASE)
+_LEADING_ARTICLE_RE = re.compile(r'^(the|a|an)\s+')
+_INITIALS_RE = re.compile(r'\b(?:[a-z] )+[a-z]\b')
+
+
+def normalise_title(title):
+    '''
+    This function returns the comparison key of a title. A leading or
+    trailing article is dropped, so 'Lord of the Rings, The' and
+    'The Lord of the Rings' both become 'lord of the rings'.
+    '''
+    key = fold(_TRAILING_ARTICLE_RE.sub('', title))
+    return _LEADING_ARTICLE_RE.sub('', key)
+
+
+def normalise_author(name):
+    '''
+    This function returns the comparison key of an author name. A name
+    written 'Surname, Forenames' is turned round and initials are joined,
+    so 'Tolkien, J. R. R.' and 'J.R.R. Tolkien' both become
+    'jrr tolkien'.
+    '''
+    if name.count(',') == 1:
+        surname, forenames = name.split(',')
+        name = f"{forenames} {surname}"
+    key = fold(name)
+    return _INITIALS_RE.sub(lambda m: m.group(0).replace(' ', ''), key)
+
+
+def shingles(key):
+    '''
+    This function returns the set of character 3-grams of a key.
+    '''
+    padded = f" {key} "
+    if len(padded) <= 3:
+        return {padded}
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# Permuted hashes of each 3-gram seen so far. A catalog uses a limited
+# set of 3-grams, so most signatures are built from cached values.
+_gram_hashes = {}
+
+
+def _hashes(gram):
+    hashes = _gram_hashes.get(gram)
+    if hashes is None:
+        h = zlib.crc32(gram.encode('utf-8'))
+        hashes = tuple(((a * h + b) & _MASK) for a, b in _PERMUTATIONS)
+        _gram_hashes[gram] = hashes
+    return hashes
+
+
+def minhash(grams):
+    '''
+    This function returns the MinHash signature of a set of 3-grams.
+    '''
+    return list(map(min, zip(*map(_hashes, grams))))
+
+
+def jaccard(grams_a, grams_b):
+    return len(grams_a & grams_b) / len(grams_a | grams_b)
+
+
+def _discard(table, entry, record_id):
+    ids = table[entry]
+    ids.remove(record_id)
+    if not ids:
+        del table[entry]
+
+
+class DedupIndex:
+    '''
+    This class holds the normalised keys and LSH buckets of one kind of
+    record (TITLE or AUTHOR) so that new names can be checked against
+    the catalog as they are entered.
+    '''
+
+    def __init__(self, kind=TITLE, threshold=DEFAULT_THRESHOLD):
+        self.kind = kind
+        self.threshold = threshold
+        self.normalise = normalise_title if kind == TITLE \
+            else normalise_author
+        self.names = {}
+        self.keys = {}
+        self.grams = {}
+        self.exact = {}
+        self.buckets = {}
+
+    def add(self, record_id, name):
+        '''
+        This function adds one record to the index, or replaces it if the
+        id is already there.
+        '''
+        self.remove(record_id)
+        if name is None:
+            return
+        key = self.normalise(name)
+        grams = shingles(key)
+        self.names[record_id] = name
+        self.keys[record_id] = key
+        self.grams[record_id] = grams
+        self.exact.setdefault(key, []).append(record_id)
+        for band in self._bands(grams):
+            self.buckets.setdefault(band, []).append(record_id)
+
+    def remove(self, record_id):
+        '''
+        This function removes one record from the index.
+        '''
+        if self.names.pop(record_id, None) is None:
+            return
+        key = self.keys.pop(record_id)
+        grams = self.grams.pop(record_id)
+        _discard(self.exact, key, record_id)
+        for band in self._bands(grams):
+            _discard(self.buckets, band, record_id)
+
+    @staticmethod
+    def _bands(grams):
+        signature = minhash(grams)
+        return [(i, tuple(signature[i * ROWS:(i + 1) * ROWS]))
+                for i in range(BANDS)]
+
+    def similar(self, name):
+        '''
+        This function returns the (id, name, similarity) of the records
+        that are near-duplicates of name, most similar first.
+        '''
+        key = self.normalise(name)
+        grams = shingles(key)
+        found = {record_id: 1.0 for record_id in self.exact.get(key, [])}
+        compared = set(found)
+        for band in self._bands(grams):
+            ids = self.buckets.get(band, ())
+            if len(ids) > MAX_BUCKET:
+                continue  # as in candidate_pairs()
+            for record_id in ids:
+                if record_id in compared:
+                    continue
+                compared.add(record_id)
+                score = jaccard(grams, self.grams[record_id])
+                if score >= self.threshold:
+                    found[record_id] = score
+        matches = [(record_id, self.names[record_id], score)
+                   for record_id, score in found.items()]
+        matches.sort(key=lambda match: (-match[2], match[0]))
+        return matches
+
+    def candidate_pairs(self):
+        '''
+        This function returns every near-duplicate pair in the index as
+        (similarity, id_a, id_b) with id_a < id_b, most similar first.
+        Records with the same normalised key are paired with the lowest
+        id of their group rather than with each other.
+        '''
+        pairs = {}
+        for ids in self.exact.values():
+            first = min(ids)
+            for record_id in ids:
+                if record_id != first:
+                    pairs[(first, record_id)] = 1.0
+        # A pair can share several bands but is only compared once
+        compared = set(pairs)
+        for ids in self.buckets.values():
+            if len(ids) < 2 or len(ids) > MAX_BUCKET:
+                continue
+            for pair in combinations(sorted(set(ids)), 2):
+                if pair in compared:
+                    continue
+                compared.add(pair)
+                id_a, id_b = pair
+                if self.keys[id_a] == self.keys[id_b]:
+                    continue
+                score = jaccard(self.grams[id_a], self.grams[id_b])
+                if score >= self.threshold:
+                    pairs[(id_a, id_b)] = score
+        result = [(score, id_a, id_b)
+                  for (id_a, id_b), score in pairs.items()]
+        result.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+        return result
+
+
+def build_index(db, kind=TITLE, threshold=DEFAULT_THRESHOLD):
+    '''
+    This function builds a DedupIndex of all the titles or author names
+    in the database.
+    '''
+    index = DedupIndex(kind, threshold)
+    cursor = db.cursor()
+    cursor.row_factory = None
+    cursor.execute(SQL['book_titles'] if kind == TITLE
+                   else SQL['author_names'])
+    for record_id, name in cursor:
+        index.add(record_id, name)
+    cursor.close()
+    return index
+
+
+class CatalogChecker:
+    '''
+    This class checks new titles or author names against the catalog
+    held in a database connection. Writes through the same connection
+    are applied to the index with add() and remove(). The index is
+    rebuilt after another connection has written to the database.
+    '''
+
+    def __init__(self, db, kind=TITLE, threshold=DEFAULT_THRESHOLD):
+        self.db = db
+        self.kind = kind
+        self.threshold = threshold
+        self._index = None
+        self._version = None
+
+    def similar(self, name):
+        version = data_version(self.db)
+        if self._index is None or version != self._version:
+            self._index = build_index(self.db, self.kind, self.threshold)
+            self._version = version
+        return self._index.similar(name)
+
+    def add(self, record_id, name):
+        if self._index is not None:
+            self._index.add(record_id, name)
+
+    def remove(self, record_id):
+        if self._index is not None:
+            self._index.remove(record_id)
+
+
+def find_duplicates(db, kind=TITLE, threshold=DEFAULT_THRESHOLD):
+    '''
+    This function returns the near-duplicate pairs of titles or author
+    names in the database as (similarity, id_a, name_a, id_b, name_b).
+    '''
+    index = build_index(db, kind, threshold)
+    return [(score, id_a, index.names[id_a], id_b, index.names[id_b])
+            for score, id_a, id_b in index.candidate_pairs()]
+
+
+def write_report(pairs, filepath):
+    '''
+    This function saves candidate pairs to a CSV file with the columns
+    similarity,id_a,name_a,id_b,name_b for review. Names containing
+    commas are quoted. Delete the rows that are not duplicates, and the
+    file can be passed to shelf_merge.py to merge the rest.
+    '''
+    with open(filepath, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['similarity', 'id_a', 'name_a', 'id_b', 'name_b'])
+        for score, id_a, name_a, id_b, name_b in pairs:
+            writer.writerow([f"{score:.2f}", id_a, name_a, id_b, name_b])
+    print(f"Saved {len(pairs)} candidate pairs to {filepath}")
+
+
+def read_report(filepath):
+    '''
+    This function reads a report saved by write_report() and returns its
+    pairs as (similarity, id_a, name_a, id_b, name_b).
+    '''
+    pairs = []
+    with open(filepath, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)  # skip the header row
+        for row in reader:
+            if row:
+                pairs.append((float(row[0]), int(row[1]), row[2],
+                              int(row[3]), row[4]))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Find near-duplicate titles or authors')
+    parser.add_argument('database')
+    parser.add_argument('--kind', choices=(TITLE, AUTHOR), default=TITLE)
+    parser.add_argument('--threshold', type=float,
+                        default=DEFAULT_THRESHOLD)
+    parser.add_argument('--report', help='CSV file for the candidate pairs')
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.database)
+    start = time.perf_counter()
+    pairs = find_duplicates(db, args.kind, args.threshold)
+    elapsed = time.perf_counter() - start
+    db.close()
+    print(f"Found {len(pairs)} candidate {args.kind} pairs "
+          f"in {elapsed:.1f}s.")
+    if args.report:
+        write_report(pairs, args.report)
+    else:
+        for score, id_a, name_a, id_b, name_b in pairs:
+            print(f"{score:.2f} : {id_a} {name_a} : {id_b} {name_b}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# Import libraries
+import argparse
+import os
+import random
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import shelf_profile
+from shelf_queries import SQL, create_schema
+
+# =========================================================================
+# Parallel import of large stock files
+#
+# load_stock_from_file() parses a stock file one line at a time in a
+# single thread, which limits multi-GB supplier files to the speed of one
+# core. import_stock_parallel() splits the file at line boundaries into
+# byte ranges, parses the ranges in a process pool and inserts the
+# parsed books from the main process, the single SQLite writer, in
+# batches inside one transaction. Each worker counts the lines in its
+# range, so line numbers in error messages match the sequential loader.
+#
+# Benchmark on a generated file:
+#     python shelf_import.py big_stock.txt --generate 5000000
+#     python shelf_import.py big_stock.txt --db bench.db --workers 8
+
+# Files at least this large are imported in parallel by the menu
+PARALLEL_IMPORT_BYTES = 64 * 1024 * 1024
+
+# Bytes parsed by one worker task
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# Rows per executemany() call
+INSERT_BATCH = 50000
+
+# Chunks submitted to the pool but not yet inserted, per parser process.
+# Parsed chunks wait in memory until the writer reaches them, so only a
+# few are queued ahead of it.
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+
+
+def parse_stock_line(line):
+    '''
+    This function parses one line of a stock file (id,title,authorID,qty)
+    and returns it as a (book_id, title, author_id, qty) tuple. It returns
+    None for empty lines and comments and raises ValueError with the
+    reason if the line cannot be used.
+    '''
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None  # skip empty lines and comments
+    parts = line.split(',')
+    if len(parts) != 4:
+        raise ValueError("incorrect format")
+    try:
+        return (int(parts[0].strip()), parts[1].strip(),
+                int(parts[2].strip()), int(parts[3].strip()))
+    except ValueError:
+        raise ValueError("invalid data")
+
+
+def split_file(filepath, chunk_bytes=CHUNK_BYTES):
+    '''
+    This function divides a file into (start, end) byte ranges of about
+    chunk_bytes each. Every range ends just after a newline, so no line
+    is split between two ranges.
+    '''
+    size = os.path.getsize(filepath)
+    ranges = []
+    with open(filepath, 'rb') as file:
+        start = 0
+        while start < size:
+            end = start + chunk_bytes
+            if end >= size:
+                end = size
+            else:
+                file.seek(end)
+                file.readline()  # move on to the end of this line
+                end = file.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_chunk(filepath, start, end):
+    '''
+    This function parses the lines in one byte range of a stock file. It
+    runs in a worker process and returns (stock, errors, line_count),
+    where errors holds (line number within the range, reason) pairs.
+    '''
+    with open(filepath, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    text = data.decode('utf-8')
+    # Split on the same line endings as a file opened in text mode
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if lines[-1] == '':
+        lines.pop()  # the range ends with a newline
+    stock = []
+    errors = []
+    for line_num, line in enumerate(lines, start=1):
+        try:
+            book = parse_stock_line(line)
+        except ValueError as e:
+            errors.append((line_num, str(e)))
+            continue
+        if book is not None:
+            stock.append(book)
+    return stock, errors, len(lines)
+
+
+def _parse_range(args):
+    return parse_chunk(*args)
+
+
+def _parse_ranges(tasks, workers):
+    '''
+    This function yields the parse results of the byte ranges in file
+    order. At most CHUNKS_IN_FLIGHT_PER_WORKER ranges per parser process
+    are submitted ahead of the one being yielded. If the pool of parser
+    processes breaks, the remaining ranges are parsed in this process
+    instead.
+    '''
+    window = CHUNKS_IN_FLIGHT_PER_WORKER * (workers or os.cpu_count() or 1)
+    done = 0
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque(pool.submit(_parse_range, task)
+                            for task in tasks[:window])
+            submitted = len(pending)
+            while pending:
+                result = pending.popleft().result()
+                if submitted < len(tasks):
+                    pending.append(pool.submit(_parse_range,
+                                               tasks[submitted]))
+                    submitted += 1
+                yield result
+                done += 1
+    except BrokenProcessPool:
+        print("Parser processes stopped. Parsing the rest of the file "
+              "in a single process.")
+        yield from map(_parse_range, tasks[done:])
+
+
+def import_stock_parallel(db, filepath, workers=None,
+                          chunk_bytes=CHUNK_BYTES):
+    '''
+    This function imports a stock file into the book table using a pool
+    of parser processes. Books whose id is already in the table are
+    skipped. It returns the number of books inserted, or None if the
+    file cannot be read.
+    '''
+    try:
+        ranges = split_file(filepath, chunk_bytes)
+    except OSError as e:
+        print(f"Error reading file: {e}")
+        return None
+
+    start_time = time.perf_counter()
+    cursor = db.cursor()
+    inserted = 0
+    parsed = 0
+    line_offset = 0
+    tasks = [(filepath, start, end) for start, end in ranges]
+    try:
+        # The chunks come back in file order, so each chunk's line
+        # numbers follow on from the lines before it
+        for stock, errors, line_count in _parse_ranges(tasks, workers):
+            for line_num, reason in errors:
+                print(f"Skipping line {line_offset + line_num}: "
+                      f"{reason}")
+            line_offset += line_count
+            parsed += len(stock)
+            for i in range(0, len(stock), INSERT_BATCH):
+                before = db.total_changes
+                cursor.executemany(SQL['insert_book_if_new'],
+                                   stock[i:i + INSERT_BATCH])
+                inserted += db.total_changes - before
+        db.commit()
+    except (OSError, UnicodeDecodeError) as e:
+        db.rollback()
+        print(f"Error reading file: {e}")
+        return None
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Loaded {inserted} books from {filepath} in {elapsed:.1f}s "
+          f"({line_offset / elapsed:,.0f} lines/s).")
+    if parsed > inserted:
+        print(f"Skipped {parsed - inserted} books whose id is already "
+              f"in the database.")
+    return inserted
+
+
+def write_sample_file(filepath, books, seed=0):
+    '''
+    This function writes a generated stock file for benchmarking.
+    '''
+    rng = random.Random(seed)
+    with open(filepath, 'w', encoding='utf-8') as file:
+        file.write("# Format: id,title,authorID,qty\n")
+        for book_id in range(1000, 1000 + books):
+            file.write(f"{book_id},Title {rng.random():.12f},"
+                       f"{rng.randrange(1000, 100000)},"
+                       f"{rng.randrange(100)}\n")
+    print(f"Wrote {books} books to {filepath}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import a stock file using parallel parser processes')
+    parser.add_argument('filepath')
+    parser.add_argument('--db', default='ebookstore.db')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parser processes (default: one per core)')
+    parser.add_argument('--generate', type=int, metavar='BOOKS',
+                        help='write a sample file of BOOKS books instead')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='save a profile of the import in DIR')
+    args = parser.parse_args()
+
+    if args.generate:
+        write_sample_file(args.filepath, args.generate)
+        return
+    db = sqlite3.connect(args.db)
+    create_schema(db.cursor())
+    profiler = shelf_profile.Profiler(args.profile) if args.profile \
+        else None
+    with shelf_profile.track(profiler, 'import_stock_parallel'):
+        import_stock_parallel(db, args.filepath, args.workers)
+    db.close()
+    if profiler is not None:
+        profiler.write_summary()
+
+
+if __name__ == '__main__':
+    main()
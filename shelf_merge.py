@@ -0,0 +1,166 @@
+# Import libraries
+import argparse
+import sqlite3
+import time
+
+from shelf_dedup import AUTHOR, find_duplicates, read_report
+from shelf_queries import SQL
+
+# =========================================================================
+# Bulk author merge
+#
+# update_auth_name() repoints one book at a time. merge_authors() takes a
+# mapping of duplicate authorIDs to canonical authorIDs and, in one
+# transaction, repoints every book of the duplicates to the canonical
+# authors and deletes the duplicate author records. The mapping is loaded
+# into a temporary table, so the work is done by two set-based statements
+# however many authors are merged.
+#
+# Merge from a mapping file (one 'duplicate_id,canonical_id' per line),
+# from a reviewed shelf_dedup.py report, or straight from a dedup pass of
+# authors whose normalised names are identical:
+#     python shelf_merge.py ebookstore.db --mapping merge.txt
+#     python shelf_merge.py ebookstore.db --report dupes.csv
+#     python shelf_merge.py ebookstore.db --dedup
+
+
+def resolve_mapping(mapping):
+    '''
+    This function follows chains in a {duplicate: canonical} mapping, so
+    that if 2 merges into 3 and 3 into 4, both 2 and 3 merge into 4.
+    Authors mapped to themselves are dropped. It raises ValueError if the
+    mapping contains a cycle.
+    '''
+    resolved = {}
+    for dup in mapping:
+        seen = [dup]
+        canon = mapping[dup]
+        while canon in mapping and canon != mapping[canon]:
+            if canon in seen:
+                raise ValueError(f"Author merge cycle: {seen + [canon]}")
+            seen.append(canon)
+            canon = mapping[canon]
+        if canon != dup:
+            resolved[dup] = canon
+    return resolved
+
+
+def mapping_from_pairs(pairs, min_similarity=1.0):
+    '''
+    This function turns dedup pairs (similarity, id_a, name_a, id_b,
+    name_b) into a {duplicate: canonical} mapping. Pairs are grouped, and
+    the lowest authorID of each group is kept as the canonical author.
+    '''
+    parent = {}
+
+    def root(author_id):
+        parent.setdefault(author_id, author_id)
+        while parent[author_id] != author_id:
+            parent[author_id] = parent[parent[author_id]]
+            author_id = parent[author_id]
+        return author_id
+
+    for score, id_a, _, id_b, _ in pairs:
+        if score >= min_similarity:
+            root_a, root_b = root(id_a), root(id_b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+    return {author_id: root(author_id) for author_id in list(parent)
+            if root(author_id) != author_id}
+
+
+def read_mapping(filepath):
+    '''
+    This function reads a mapping file with one 'duplicate_id,
+    canonical_id' pair per line. Empty lines and comments are skipped.
+    '''
+    mapping = {}
+    with open(filepath, 'r', encoding='utf-8') as file:
+        for line_num, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                dup, canon = line.split(',')
+                mapping[int(dup)] = int(canon)
+            except ValueError:
+                print(f"Skipping line {line_num}: invalid data")
+    return mapping
+
+
+def merge_authors(db, mapping):
+    '''
+    This function merges duplicate authors into canonical authors in one
+    transaction. mapping is {duplicate authorID: canonical authorID}. It
+    returns a dict of authors_merged (after chains are resolved),
+    books_repointed, authors_deleted and seconds. If a canonical author
+    does not exist nothing is changed and ValueError is raised.
+    '''
+    start = time.perf_counter()
+    mapping = resolve_mapping(mapping)
+    cursor = db.cursor()
+    cursor.row_factory = None
+    try:
+        cursor.execute(SQL['create_author_merge'])
+        cursor.execute(SQL['clear_author_merge'])
+        cursor.executemany(SQL['insert_author_merge'], mapping.items())
+        cursor.execute(SQL['count_missing_canonical'])
+        missing = cursor.fetchone()[0]
+        if missing:
+            raise ValueError(f"{missing} canonical authors are not in "
+                             f"the author table")
+        cursor.execute(SQL['merge_book_authors'])
+        books_repointed = cursor.rowcount
+        cursor.execute(SQL['delete_merged_authors'])
+        authors_deleted = cursor.rowcount
+        cursor.execute(SQL['clear_author_merge'])
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return {'authors_merged': len(mapping),
+            'books_repointed': books_repointed,
+            'authors_deleted': authors_deleted,
+            'seconds': time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Merge duplicate authors into canonical authors')
+    parser.add_argument('database')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--mapping', help="file of 'duplicate_id,"
+                        "canonical_id' lines")
+    source.add_argument('--report', help='reviewed shelf_dedup.py report '
+                        'of author pairs')
+    source.add_argument('--dedup', action='store_true',
+                        help='merge authors whose normalised names match')
+    parser.add_argument('--min-similarity', type=float, default=0.0,
+                        help='lowest similarity merged from --report '
+                        '(default: every row of the report)')
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.database)
+    if args.mapping:
+        mapping = read_mapping(args.mapping)
+    elif args.report:
+        mapping = mapping_from_pairs(read_report(args.report),
+                                     args.min_similarity)
+    else:
+        mapping = mapping_from_pairs(find_duplicates(db, AUTHOR))
+
+    try:
+        result = merge_authors(db, mapping)
+    except ValueError as e:
+        print(f"Merge cancelled: {e}")
+        return
+    finally:
+        db.close()
+    print(f"Merged {result['authors_merged']} duplicate authors: "
+          f"{result['books_repointed']} books repointed, "
+          f"{result['authors_deleted']} authors deleted "
+          f"in {result['seconds']:.3f}s.")
+
+
+if __name__ == '__main__':
+    main()
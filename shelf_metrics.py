@@ -0,0 +1,411 @@
+# Import libraries
+import json
+import re
+import sqlite3
+import time
+from contextlib import contextmanager, nullcontext
+
+# =========================================================================
+# Query-level instrumentation for ebookstore.db
+#
+# Connections made through QueryMetrics.connect() time every statement
+# the app executes. Statements are grouped by query shape (the SQL with
+# whitespace collapsed and literals replaced by ?), so the same search
+# run with different titles is counted once. Recorded per shape:
+# a latency histogram and the rows returned. Recorded per menu
+# operation: statements, rows, elapsed time and commits. Each commit of
+# a pending transaction is a journal and database fsync, so the commit
+# count is the fsync count to watch. Statements slower than
+# slow_threshold are written to a slow-query log together with their
+# EXPLAIN QUERY PLAN output.
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Operation name used for statements run outside any tracked operation
+IDLE_OPERATION = 'idle'
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE_RE = re.compile(r'\s+')
+
+
+def query_shape(sql):
+    '''
+    This function returns the shape of an SQL statement: whitespace is
+    collapsed and string and number literals are replaced by ? so that
+    statements differing only in their values are grouped together.
+    '''
+    shape = _LITERAL_RE.sub('?', sql)
+    return _SPACE_RE.sub(' ', shape).strip()
+
+
+def _new_histogram():
+    # One count per bucket plus the +Inf bucket
+    return [0] * (len(LATENCY_BUCKETS) + 1)
+
+
+def _observe(histogram, elapsed):
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if elapsed <= bound:
+            histogram[i] += 1
+            return
+    histogram[-1] += 1
+
+
+def _label(value):
+    '''
+    This function escapes a Prometheus label value.
+    '''
+    return (value.replace('\\', '\\\\')
+                 .replace('"', '\\"')
+                 .replace('\n', '\\n'))
+
+
+class QueryMetrics:
+    '''
+    This class collects statement latency, rows, commits and slow
+    queries for the connections created by its connect() method.
+    '''
+
+    def __init__(self, slow_threshold=0.05):
+        self.slow_threshold = slow_threshold
+        self.shapes = {}
+        self.operations = {}
+        self.slow_queries = []
+        self.plans = {}
+        self.current_operation = IDLE_OPERATION
+
+    def connect(self, database, **kwargs):
+        '''
+        This function opens an instrumented sqlite3 connection that
+        reports to this QueryMetrics object.
+        '''
+        db = sqlite3.connect(database, factory=InstrumentedConnection,
+                             **kwargs)
+        db.metrics = self
+        return db
+
+    @contextmanager
+    def operation(self, name):
+        '''
+        This function attributes all statements and commits inside the
+        with block to the named operation, eg a main menu option.
+        '''
+        previous = self.current_operation
+        self.current_operation = name
+        op_stats = self._operation_stats(name)
+        op_stats['calls'] += 1
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            op_stats['wall_seconds'] += time.perf_counter() - start
+            self.current_operation = previous
+
+    def _operation_stats(self, name):
+        op_stats = self.operations.get(name)
+        if op_stats is None:
+            op_stats = {'calls': 0, 'wall_seconds': 0.0, 'statements': 0,
+                        'db_seconds': 0.0, 'rows': 0, 'commits': 0,
+                        'commit_seconds': 0.0}
+            self.operations[name] = op_stats
+        return op_stats
+
+    def record_statement(self, db, operation, shape, sql, params,
+                         elapsed, rows):
+        '''
+        This function records one finished statement against the
+        operation it was started in. It is called by InstrumentedCursor
+        once the statement's rows have been fetched.
+        '''
+        shape_stats = self.shapes.get(shape)
+        if shape_stats is None:
+            shape_stats = {'count': 0, 'sum_seconds': 0.0,
+                           'max_seconds': 0.0, 'rows': 0,
+                           'buckets': _new_histogram()}
+            self.shapes[shape] = shape_stats
+        shape_stats['count'] += 1
+        shape_stats['sum_seconds'] += elapsed
+        shape_stats['max_seconds'] = max(shape_stats['max_seconds'],
+                                         elapsed)
+        shape_stats['rows'] += rows
+        _observe(shape_stats['buckets'], elapsed)
+
+        op_stats = self._operation_stats(operation)
+        op_stats['statements'] += 1
+        op_stats['db_seconds'] += elapsed
+        op_stats['rows'] += rows
+
+        if elapsed >= self.slow_threshold:
+            self.slow_queries.append({
+                'operation': operation,
+                'shape': shape,
+                'sql': sql,
+                'params': [repr(p) for p in params or ()],
+                'seconds': elapsed,
+                'rows': rows,
+                'plan': self._explain(db, shape, sql, params),
+                })
+
+    def record_commit(self, elapsed):
+        '''
+        This function records one commit of a pending transaction.
+        '''
+        op_stats = self._operation_stats(self.current_operation)
+        op_stats['commits'] += 1
+        op_stats['commit_seconds'] += elapsed
+
+    def _explain(self, db, shape, sql, params):
+        '''
+        This function returns the EXPLAIN QUERY PLAN lines of a slow
+        statement. The plan is captured once per query shape. params is
+        None for executemany(), and the statement is then planned with
+        its parameters bound as NULL, which does not change the plan.
+        A failed EXPLAIN is not kept, so it is tried again next time.
+        '''
+        if shape in self.plans:
+            return self.plans[shape]
+        plan = []
+        if sql.lstrip()[:6].upper() in ('SELECT', 'INSERT', 'UPDATE',
+                                        'DELETE'):
+            if params is None:
+                params = (None,) * sql.count('?')
+            # A plain cursor so the EXPLAIN itself is not recorded
+            explain_cursor = sqlite3.Connection.cursor(db)
+            explain_cursor.row_factory = None
+            try:
+                explain_cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = [row[3] for row in explain_cursor.fetchall()]
+            except sqlite3.Error as e:
+                return [f"EXPLAIN failed: {e}"]
+            finally:
+                explain_cursor.close()
+        self.plans[shape] = plan
+        return plan
+
+    # ---------------------------------------------------------------------
+    # Export functions
+
+    def to_dict(self):
+        '''
+        This function returns all collected metrics as plain data.
+        '''
+        shapes = {}
+        for shape, stats in self.shapes.items():
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            buckets['+Inf'] = stats['count']
+            shapes[shape] = dict(stats, buckets=buckets)
+        return {'latency_buckets': list(LATENCY_BUCKETS),
+                'slow_threshold': self.slow_threshold,
+                'query_shapes': shapes,
+                'operations': self.operations,
+                'slow_queries': self.slow_queries}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        '''
+        This function returns all collected metrics in the Prometheus
+        text exposition format.
+        '''
+        lines = [
+            '# HELP shelf_query_duration_seconds Statement latency '
+            'by query shape.',
+            '# TYPE shelf_query_duration_seconds histogram']
+        for shape, stats in self.shapes.items():
+            label = f'shape="{_label(shape)}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                cumulative += count
+                lines.append(f'shelf_query_duration_seconds_bucket'
+                             f'{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'shelf_query_duration_seconds_bucket'
+                         f'{{{label},le="+Inf"}} {stats["count"]}')
+            lines.append(f'shelf_query_duration_seconds_sum{{{label}}} '
+                         f'{stats["sum_seconds"]}')
+            lines.append(f'shelf_query_duration_seconds_count{{{label}}} '
+                         f'{stats["count"]}')
+
+        lines.append('# HELP shelf_query_rows_total Rows returned '
+                     'by query shape.')
+        lines.append('# TYPE shelf_query_rows_total counter')
+        for shape, stats in self.shapes.items():
+            lines.append(f'shelf_query_rows_total{{shape="{_label(shape)}"}}'
+                         f' {stats["rows"]}')
+
+        for field, help_text in (
+                ('calls', 'Times the operation was run.'),
+                ('statements', 'Statements executed by the operation.'),
+                ('rows', 'Rows returned to the operation.'),
+                ('commits', 'Committed transactions (fsyncs) '
+                            'by the operation.')):
+            name = f'shelf_operation_{field}_total'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for op, stats in self.operations.items():
+                lines.append(f'{name}{{operation="{_label(op)}"}} '
+                             f'{stats[field]}')
+
+        lines.append('# HELP shelf_operation_db_seconds_total Time spent '
+                     'in statements by the operation.')
+        lines.append('# TYPE shelf_operation_db_seconds_total counter')
+        for op, stats in self.operations.items():
+            lines.append(f'shelf_operation_db_seconds_total'
+                         f'{{operation="{_label(op)}"}} '
+                         f'{stats["db_seconds"]}')
+
+        lines.append('# HELP shelf_slow_queries_total Statements slower '
+                     'than the slow-query threshold.')
+        lines.append('# TYPE shelf_slow_queries_total counter')
+        lines.append(f'shelf_slow_queries_total {len(self.slow_queries)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filepath):
+        '''
+        This function saves the metrics to a file: Prometheus text if
+        the file ends in .prom, otherwise JSON.
+        '''
+        if filepath.endswith('.prom'):
+            output = self.to_prometheus()
+        else:
+            output = self.to_json()
+        with open(filepath, 'w', encoding='utf-8') as file:
+            file.write(output)
+        print(f"Query metrics saved to {filepath}")
+
+
+def track(metrics, name):
+    '''
+    This function returns metrics.operation(name), or a context that does
+    nothing if instrumentation is switched off (metrics is None).
+    '''
+    if metrics is None:
+        return nullcontext()
+    return metrics.operation(name)
+
+
+# =========================================================================
+# Instrumented connection and cursor
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    '''
+    This cursor times each statement from execute() until its last row
+    has been fetched, so a SELECT's cost includes fetchall().
+    '''
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._db = db
+        self._pending = None
+
+    def _begin(self, sql, params):
+        self._finish()
+        metrics = self._db.metrics
+        if metrics is not None:
+            # [operation, shape, sql, params, elapsed seconds, rows]
+            self._pending = [metrics.current_operation, query_shape(sql),
+                             sql, params, 0.0, 0]
+
+    def _finish(self):
+        pending = self._pending
+        if pending is None:
+            return
+        self._pending = None
+        self._db.metrics.record_statement(self._db, *pending)
+
+    def _add(self, start, rows, done):
+        if self._pending is not None:
+            self._pending[4] += time.perf_counter() - start
+            self._pending[5] += rows
+            if done:
+                self._finish()
+
+    def execute(self, sql, params=()):
+        self._begin(sql, params)
+        start = time.perf_counter()
+        try:
+            super().execute(sql, params)
+        finally:
+            # Statements that return no rows are finished straight away
+            self._add(start, 0, self.description is None)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        # No single set of parameters stands for the whole statement
+        self._begin(sql, None)
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_params)
+        finally:
+            self._add(start, 0, True)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        if size is None:
+            size = self.arraysize
+        rows = super().fetchmany(size)
+        self._add(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._add(start, 0, True)
+            raise
+        self._add(start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        # Record a statement whose rows were never fully fetched, eg a
+        # single fetchone() on a throwaway cursor.
+        self._finish()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''
+    This connection hands out InstrumentedCursor objects and counts the
+    commits that write a pending transaction to disk.
+    '''
+    metrics = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        pending = self.in_transaction
+        start = time.perf_counter()
+        super().commit()
+        if pending and self.metrics is not None:
+            self.metrics.record_commit(time.perf_counter() - start)
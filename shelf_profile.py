@@ -0,0 +1,171 @@
+# Import libraries
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# =========================================================================
+# Per-operation profiling for ebookstore.db
+#
+# Operations run through Profiler.operation() are profiled with cProfile
+# and tracemalloc. For each operation a text report is saved in the
+# profile directory with:
+#     wall time, and how much of it was spent waiting at input() prompts
+#     peak traced memory
+#     the allocation sites still holding memory when the operation ended
+#     the cProfile functions with the highest cumulative time
+# A summary table of every operation in the session is printed and
+# saved as summary.txt by write_summary().
+#
+# Wall times include the overhead of cProfile and tracemalloc, so they
+# are for comparing operations and runs, not for absolute timings. Only
+# the calling process is profiled, not the parser processes of a
+# parallel import.
+#
+# Profile the menu program, or a headless import:
+#     SHELF_PROFILE=profiles python shelf_track_dec25.py
+#     python shelf_import.py stock.txt --profile profiles
+
+# Rows in the cProfile listing and allocation sites in each report
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 10
+
+_INPUT_FUNCTION = '<built-in method builtins.input>'
+
+# Memory used by the profilers themselves is left out of the allocation
+# sites
+_ALLOCATION_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    )
+
+
+def _input_seconds(stats):
+    '''
+    This function returns the time spent inside input() calls, which is
+    the time an interactive operation waited for the user.
+    '''
+    for (_, _, function), values in stats.stats.items():
+        if function == _INPUT_FUNCTION:
+            return values[2]  # total time inside the function
+    return 0.0
+
+
+class Profiler:
+    '''
+    This class profiles operations and saves one report per operation in
+    a directory.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.results = []
+        self._active = None
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def operation(self, name):
+        '''
+        This function profiles the code run inside the with block as
+        operation name. An operation started inside another one is
+        profiled as part of the outer operation.
+        '''
+        if self._active is not None:
+            yield
+            return
+        self._active = name
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            self._active = None
+            self._save(name, elapsed, peak, profile, before, after)
+
+    def _save(self, name, elapsed, peak, profile, before, after):
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        waiting = _input_seconds(stats)
+        sites = after.filter_traces(_ALLOCATION_FILTERS).compare_to(
+            before.filter_traces(_ALLOCATION_FILTERS), 'lineno')
+        sites = [site for site in sites if site.size_diff > 0]
+        sites = sites[:TOP_ALLOCATIONS]
+
+        path = os.path.join(self.directory,
+                            f"{len(self.results) + 1:03d}-{name}.txt")
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(f"Operation: {name}\n")
+            file.write(f"Wall time: {elapsed:.3f} s "
+                       f"({waiting:.3f} s waiting for input)\n")
+            file.write(f"Peak traced memory: {peak / 2 ** 20:.2f} MB\n\n")
+            file.write("Allocation sites still holding memory at the end "
+                       "of the operation\n")
+            if not sites:
+                file.write("  none\n")
+            for site in sites:
+                frame = site.traceback[0]
+                file.write(f"  {frame.filename}:{frame.lineno}: "
+                           f"+{site.size_diff / 1024:.1f} KiB "
+                           f"({site.count_diff:+d} blocks)\n")
+            file.write(f"\nFunctions by cumulative time "
+                       f"(top {TOP_FUNCTIONS})\n")
+            stats.stream = file
+            stats.sort_stats(pstats.SortKey.CUMULATIVE)
+            stats.print_stats(TOP_FUNCTIONS)
+
+        self.results.append({'operation': name, 'seconds': elapsed,
+                             'input_seconds': waiting, 'peak_bytes': peak,
+                             'calls': stats.total_calls, 'path': path})
+
+    def summary(self):
+        '''
+        This function returns the table of all operations profiled so far.
+        '''
+        lines = [" # : operation              : wall s : input s : "
+                 "  calls   : peak MB : report"]
+        for i, result in enumerate(self.results, start=1):
+            lines.append(f"{i:2d} : {result['operation']:<22} : "
+                         f"{result['seconds']:6.3f} : "
+                         f"{result['input_seconds']:7.3f} : "
+                         f"{result['calls']:9d} : "
+                         f"{result['peak_bytes'] / 2 ** 20:7.2f} : "
+                         f"{os.path.basename(result['path'])}")
+        return '\n'.join(lines)
+
+    def write_summary(self):
+        '''
+        This function prints the summary table and saves it as
+        summary.txt in the profile directory.
+        '''
+        table = self.summary()
+        path = os.path.join(self.directory, 'summary.txt')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(table + '\n')
+        print(table)
+        print(f"Profiles saved to {self.directory}")
+
+
+def track(profiler, name):
+    '''
+    This function returns profiler.operation(name), or a context that
+    does nothing if profiling is switched off (profiler or name is None).
+    '''
+    if profiler is None or name is None:
+        return nullcontext()
+    return profiler.operation(name)
@@ -0,0 +1,323 @@
+# Import libraries
+import random
+import re
+import sqlite3
+import sys
+
+# =========================================================================
+# SQL registry for ebookstore.db
+#
+# Every statement the app executes lives here under a name, so that a
+# schema change can be checked against all of them at once. Run this
+# file to build a large generated catalog and check the query plan of
+# each statement:
+#     python shelf_queries.py [number of books]
+# It exits with status 1 if a hot-path query no longer uses its index
+# or any query needs a temporary B-tree to sort.
+
+# Tables and indexes, created in order by initialise_ebookstore_db()
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS book(
+                id INTEGER PRIMARY KEY,
+                title TEXT,
+                authorID INTEGER,
+                qty INTEGER)''',
+    '''CREATE TABLE IF NOT EXISTS author(
+                id INTEGER PRIMARY KEY,
+                name TEXT,
+                country TEXT)''',
+    # Books by author: author counts, joins from author to book and
+    # the orphan author check after a delete
+    '''CREATE INDEX IF NOT EXISTS idx_book_authorID
+                ON book(authorID)''',
+    # Exact author name lookups when repointing a book to an author
+    '''CREATE INDEX IF NOT EXISTS idx_author_name
+                ON author(name)''',
+    ]
+
+SQL = {
+    # Inserts
+    'insert_book': '''
+                INSERT INTO book(id, title, authorID, qty)
+                VALUES (?, ?, ?, ?)''',
+    'insert_book_if_new': '''
+                INSERT OR IGNORE INTO book(id, title, authorID, qty)
+                VALUES (?, ?, ?, ?)''',
+    'insert_author': '''
+                INSERT INTO author(id, name, country)
+                VALUES (?, ?, ?)''',
+    'insert_author_if_new': '''
+                INSERT OR IGNORE INTO author(id, name, country)
+                VALUES (?, ?, ?)''',
+
+    # Whole inventory. ORDER BY book.id keeps the listing in id order
+    # whichever table the planner chooses to drive the join from.
+    'list_books': '''
+                SELECT book.id, book.title, author.name AS author_name,
+                book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                ORDER BY book.id''',
+    'book_details': '''
+                SELECT book.title, author.name AS author_name,
+                author.country
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                ORDER BY book.id''',
+    'export_books': '''
+                SELECT id, title, authorID AS author_id, qty
+                FROM book''',
+    'book_titles': '''
+                SELECT id, title FROM book''',
+    'author_names': '''
+                SELECT id, name FROM author''',
+    # Binary snapshots, in id order so ids can be binary searched
+    'snapshot_books': '''
+                SELECT id, title, authorID, qty FROM book
+                ORDER BY id''',
+    'snapshot_authors': '''
+                SELECT id, name, country FROM author
+                ORDER BY id''',
+
+    # Single book and author lookups
+    'book_by_id': '''
+                SELECT id, title, authorID AS author_id, qty
+                FROM book
+                WHERE book.id = ?''',
+    'book_detail_by_id': '''
+                SELECT book.id, book.title,
+                author.id AS author_id, author.name AS author_name,
+                author.country, book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                WHERE book.id = ?''',
+    'book_detail_by_author_id': '''
+                SELECT book.id, book.title,
+                author.id AS author_id, author.name AS author_name,
+                author.country, book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                WHERE author.id = ?''',
+    'book_detail_by_author_name': '''
+                SELECT book.id, book.title,
+                author.id AS author_id, author.name AS author_name,
+                author.country, book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                WHERE author.name = ?''',
+    'author_by_id': '''
+                SELECT author.id, author.name, author.country
+                FROM author
+                WHERE author.id = ?''',
+    'count_books_by_author': '''
+                SELECT COUNT()
+                FROM book
+                WHERE book.authorID = ?''',
+
+    # Updates
+    'update_book_title': '''
+                UPDATE book SET title = ?
+                WHERE id = ?''',
+    'update_book_author': '''
+                UPDATE book SET authorID = ?
+                WHERE id = ?''',
+    'update_book_qty': '''
+                UPDATE book SET qty = ?
+                WHERE id = ?''',
+    'adjust_book_qty': '''
+                UPDATE book SET qty = qty + ?
+                WHERE id = ?''',
+    'update_author_name': '''
+                UPDATE author SET name = ?
+                WHERE id = ?''',
+    'update_author_country': '''
+                UPDATE author SET country = ?
+                WHERE id = ?''',
+
+    # Deletes
+    'delete_book': '''
+                DELETE FROM book WHERE id = ?''',
+    'delete_author': '''
+                DELETE FROM author WHERE id = ?''',
+    'delete_orphan_author': '''
+                DELETE FROM author WHERE id = ?
+                AND NOT EXISTS (SELECT 1 FROM book
+                                WHERE book.authorID = author.id)''',
+
+    # Bulk author merge through a temporary table of
+    # (duplicate authorID, canonical authorID) pairs
+    'create_author_merge': '''
+                CREATE TEMP TABLE IF NOT EXISTS author_merge(
+                dup INTEGER PRIMARY KEY,
+                canon INTEGER NOT NULL)''',
+    'clear_author_merge': '''
+                DELETE FROM author_merge''',
+    'insert_author_merge': '''
+                INSERT INTO author_merge(dup, canon)
+                VALUES (?, ?)''',
+    'count_missing_canonical': '''
+                SELECT COUNT()
+                FROM author_merge
+                WHERE canon NOT IN (SELECT id FROM author)''',
+    'merge_book_authors': '''
+                UPDATE book
+                SET authorID = (SELECT canon FROM author_merge
+                                WHERE dup = book.authorID)
+                WHERE authorID IN (SELECT dup FROM author_merge)''',
+    'delete_merged_authors': '''
+                DELETE FROM author
+                WHERE id IN (SELECT dup FROM author_merge)''',
+
+    # Searches
+    'book_summary_by_id': '''
+                SELECT book.id, book.title, author.name AS author_name,
+                book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                WHERE book.id = ?''',
+    'search_books_by_title': '''
+                SELECT book.id, book.title, author.name AS author_name,
+                book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                WHERE title LIKE ?
+                ORDER BY book.id''',
+    'search_books_by_author_name': '''
+                SELECT book.id, book.title, author.name AS author_name,
+                book.qty
+                FROM book INNER JOIN author
+                ON book.authorID = author.id
+                WHERE author.name LIKE ?
+                ORDER BY book.id''',
+    }
+
+# Expected query plans. Each hot-path query must show every listed
+# fragment in its EXPLAIN QUERY PLAN output and must not SCAN the book or
+# author table (scanning a small temporary table is fine).
+# Queries not listed here read the whole inventory (or use LIKE '%x%')
+# and are allowed to scan, but like every query they must not sort
+# through a temporary B-tree.
+HOT_PATH_PLANS = {
+    'book_by_id': ['SEARCH book USING INTEGER PRIMARY KEY'],
+    'book_detail_by_id': ['SEARCH book USING INTEGER PRIMARY KEY',
+                          'SEARCH author USING INTEGER PRIMARY KEY'],
+    'book_detail_by_author_id': ['SEARCH author USING INTEGER PRIMARY KEY',
+                                 'USING INDEX idx_book_authorID'],
+    'book_detail_by_author_name': ['SEARCH author USING INDEX '
+                                   'idx_author_name',
+                                   'USING INDEX idx_book_authorID'],
+    'author_by_id': ['SEARCH author USING INTEGER PRIMARY KEY'],
+    'count_books_by_author': ['USING COVERING INDEX idx_book_authorID'],
+    'update_book_title': ['SEARCH book USING INTEGER PRIMARY KEY'],
+    'update_book_author': ['SEARCH book USING INTEGER PRIMARY KEY'],
+    'update_book_qty': ['SEARCH book USING INTEGER PRIMARY KEY'],
+    'adjust_book_qty': ['SEARCH book USING INTEGER PRIMARY KEY'],
+    'update_author_name': ['SEARCH author USING INTEGER PRIMARY KEY'],
+    'update_author_country': ['SEARCH author USING INTEGER PRIMARY KEY'],
+    'delete_book': ['SEARCH book USING INTEGER PRIMARY KEY'],
+    'delete_author': ['SEARCH author USING INTEGER PRIMARY KEY'],
+    'delete_orphan_author': ['SEARCH author USING INTEGER PRIMARY KEY',
+                             'USING COVERING INDEX idx_book_authorID'],
+    'book_summary_by_id': ['SEARCH book USING INTEGER PRIMARY KEY',
+                           'SEARCH author USING INTEGER PRIMARY KEY'],
+    'merge_book_authors': ['SEARCH book USING INDEX idx_book_authorID',
+                           'SEARCH author_merge USING INTEGER PRIMARY KEY'],
+    'delete_merged_authors': ['SEARCH author USING INTEGER PRIMARY KEY'],
+    }
+
+_OLD_PLAN_TABLE = re.compile(r'^(SCAN|SEARCH) TABLE ')
+
+
+def create_schema(cursor):
+    '''
+    This function creates any missing tables and indexes.
+    '''
+    for statement in SCHEMA:
+        cursor.execute(statement)
+
+
+def explain(cursor, name):
+    '''
+    This function returns the EXPLAIN QUERY PLAN detail lines of the
+    named statement. Parameters are bound as NULL, which does not change
+    the plan SQLite chooses for a prepared statement.
+    SQLite before 3.36 writes "SCAN TABLE book" and "SEARCH TABLE book";
+    the word TABLE is removed so every version matches HOT_PATH_PLANS.
+    '''
+    sql = SQL[name]
+    params = (None,) * sql.count('?')
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return [_OLD_PLAN_TABLE.sub(r'\1 ', row[3]) for row in cursor.fetchall()]
+
+
+def check_query_plans(db):
+    '''
+    This function checks the plan of every statement in SQL against
+    HOT_PATH_PLANS. It returns a list of failure messages, empty if all
+    plans are as expected.
+    '''
+    cursor = db.cursor()
+    failures = []
+    for name in SQL:
+        statement = SQL[name].lstrip().upper()
+        if statement.startswith('CREATE'):
+            # Create temporary tables so later statements can be planned
+            cursor.execute(SQL[name])
+            continue
+        if statement.startswith('INSERT'):
+            continue  # inserts have no plan to check
+        plan = explain(cursor, name)
+        plan_str = ' | '.join(plan)
+        if any('TEMP B-TREE' in line for line in plan):
+            failures.append(f"{name}: temporary B-tree sort: {plan_str}")
+        expected = HOT_PATH_PLANS.get(name)
+        if expected is None:
+            continue
+        for fragment in expected:
+            if not any(fragment in line for line in plan):
+                failures.append(f"{name}: expected '{fragment}': "
+                                f"{plan_str}")
+        if any(line.split()[:2] in (['SCAN', 'book'], ['SCAN', 'author'])
+               for line in plan):
+            failures.append(f"{name}: full table scan: {plan_str}")
+    return failures
+
+
+def generate_catalog(db, books=200000, authors=20000, seed=0):
+    '''
+    This function fills an empty database with a generated catalog of
+    books and authors and runs ANALYZE so the planner sees the same
+    statistics it would on a large real store.
+    '''
+    rng = random.Random(seed)
+    cursor = db.cursor()
+    create_schema(cursor)
+    cursor.executemany(SQL['insert_author'],
+                       ((1000 + i, f"Author {i:06d}", f"Country {i % 50}")
+                        for i in range(authors)))
+    cursor.executemany(SQL['insert_book'],
+                       ((1000 + i, f"Title {rng.random():.12f}",
+                         1000 + rng.randrange(authors), rng.randrange(100))
+                        for i in range(books)))
+    cursor.execute('ANALYZE')
+    db.commit()
+
+
+def main(argv):
+    books = int(argv[1]) if len(argv) > 1 else 200000
+    db = sqlite3.connect(':memory:')
+    generate_catalog(db, books=books, authors=max(books // 10, 1))
+    failures = check_query_plans(db)
+    db.close()
+    if failures:
+        print(f"Query plan check failed on {books} books:")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print(f"All {len(SQL)} statements have the expected plans "
+          f"on {books} books.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,197 @@
+# Import libraries
+import sqlite3
+import sys
+import time
+import tracemalloc
+
+from shelf_queries import SQL, create_schema
+
+# =========================================================================
+# Typed records for ebookstore.db
+#
+# Rows come back from the database as Book, Author and BookWithAuthor
+# records instead of tuples, so code reads book.title rather than
+# book[1] whichever query produced the row. Records use __slots__, so
+# each one is a fixed-size object without a per-record __dict__.
+#
+# A record is filled by column name: a query only needs to select the
+# columns an operation uses (the others are None), and the columns can
+# come in any order. Query columns are named after the record fields,
+# eg 'author.name AS author_name'.
+#
+# Compare memory use and time per row with plain tuples:
+#     python shelf_records.py [number of rows]
+
+
+class Record:
+    '''
+    This class is the base of the record types. Subclasses list their
+    fields in __slots__, in the order of their constructor arguments.
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}"
+                           for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def __eq__(self, other):
+        return (type(self) is type(other)
+                and all(getattr(self, name) == getattr(other, name)
+                        for name in self.__slots__))
+
+
+class Book(Record):
+    __slots__ = ('id', 'title', 'author_id', 'qty')
+
+    def __init__(self, id=None, title=None, author_id=None, qty=None):
+        self.id = id
+        self.title = title
+        self.author_id = author_id
+        self.qty = qty
+
+
+class Author(Record):
+    __slots__ = ('id', 'name', 'country')
+
+    def __init__(self, id=None, name=None, country=None):
+        self.id = id
+        self.name = name
+        self.country = country
+
+
+class BookWithAuthor(Record):
+    __slots__ = ('id', 'title', 'author_id', 'author_name', 'country',
+                 'qty')
+
+    def __init__(self, id=None, title=None, author_id=None,
+                 author_name=None, country=None, qty=None):
+        self.id = id
+        self.title = title
+        self.author_id = author_id
+        self.author_name = author_name
+        self.country = country
+        self.qty = qty
+
+
+def row_factory(cls):
+    '''
+    This function returns a sqlite3 row_factory that makes cls records.
+    The column layout of a query is worked out once, on its first row.
+    '''
+    last = [None, None]  # [cursor.description, build function]
+
+    def layout(description):
+        names = tuple(column[0] for column in description)
+        unknown = set(names) - set(cls.__slots__)
+        if unknown:
+            raise ValueError(f"{cls.__name__} has no fields "
+                             f"{sorted(unknown)}")
+        if names == cls.__slots__[:len(names)]:
+            return lambda row: cls(*row)  # columns in field order
+        return lambda row: cls(**dict(zip(names, row)))
+
+    def make_record(cursor, row):
+        description = cursor.description
+        if description is not last[0]:
+            last[0] = description
+            last[1] = layout(description)
+        return last[1](row)
+
+    return make_record
+
+
+def fetch_one(db, sql, params, cls):
+    '''
+    This function runs a query and returns its first row as a cls record,
+    or None if there are no rows.
+    '''
+    cursor = db.cursor()
+    cursor.row_factory = row_factory(cls)
+    cursor.execute(sql, params)
+    record = cursor.fetchone()
+    cursor.close()
+    return record
+
+
+def fetch_records(db, sql, params, cls):
+    '''
+    This function runs a query and yields its rows one at a time as cls
+    records, so the whole result is never held in a list.
+    '''
+    cursor = db.cursor()
+    cursor.row_factory = row_factory(cls)
+    cursor.execute(sql, params)
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+# =========================================================================
+# Benchmark
+
+
+def _measure(label, rows, scan):
+    start = time.perf_counter()
+    scan()
+    elapsed = time.perf_counter() - start
+    # Memory is measured on a second run, as tracing slows the scan down
+    tracemalloc.start()
+    scan()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<32} : {elapsed:6.2f} s : {elapsed / rows * 1e9:6.0f} "
+          f"ns/row : {peak / 2 ** 20:8.1f} MB peak")
+
+
+def benchmark(rows):
+    '''
+    This function scans a generated book table of the given size with
+    tuples and with records, both as fetchall() lists and as generators.
+    '''
+    db = sqlite3.connect(':memory:')
+    create_schema(db.cursor())
+    db.executemany(SQL['insert_book'],
+                   ((1000 + i, f"Title {i}", 1000 + i % 1000, i % 100)
+                    for i in range(rows)))
+    db.commit()
+    sql = SQL['export_books']
+
+    def tuple_list():
+        books = db.execute(sql).fetchall()
+        return sum(book[3] for book in books)
+
+    def tuple_iter():
+        return sum(book[3] for book in db.execute(sql))
+
+    def record_list():
+        cursor = db.cursor()
+        cursor.row_factory = row_factory(Book)
+        books = cursor.execute(sql).fetchall()
+        return sum(book.qty for book in books)
+
+    def record_iter():
+        return sum(book.qty for book in fetch_records(db, sql, (), Book))
+
+    def qty_only_iter():
+        cursor = db.execute('SELECT qty FROM book')
+        return sum(row[0] for row in cursor)
+
+    print(f"Scanning {rows} books")
+    _measure("tuples, fetchall()", rows, tuple_list)
+    _measure("tuples, iterated", rows, tuple_iter)
+    _measure("Book records, fetchall()", rows, record_list)
+    _measure("Book records, iterated", rows, record_iter)
+    _measure("qty column only, iterated", rows, qty_only_iter)
+
+    book_tuple = db.execute(sql).fetchone()
+    book_record = Book(*book_tuple)
+    print(f"Size of one row: tuple {sys.getsizeof(book_tuple)} bytes, "
+          f"Book record {sys.getsizeof(book_record)} bytes "
+          f"(field values are shared and not counted)")
+    db.close()
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
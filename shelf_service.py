@@ -0,0 +1,490 @@
+# Import libraries
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from shelf_queries import SQL, create_schema
+
+# =========================================================================
+# JSON service for ebookstore.db
+#
+# Point-of-sale terminals and the web shop talk to the store over HTTP
+# instead of the input() menu. Every request is a POST with a JSON body:
+#     /search  {"title": "tale"} or {"author": "tolkien"}, optional "limit"
+#     /lookup  {"id": 3001}
+#     /stock   {"id": 3001, "delta": -1}
+#     /add     {"id": 3007, "title": "...", "qty": 5,
+#               "author_id": 1290, "name": "...", "country": "..."}
+#     /delete  {"id": 3007}
+# Reads run on a thread pool, each thread with its own read-only
+# connection. Writes are queued to a single writer task, which commits
+# all the writes waiting in the queue as one transaction. Each write runs
+# inside its own SAVEPOINT, so a failing write is rolled back and
+# reported without affecting the rest of its batch.
+#
+# Start the service, then measure it with the load-test client:
+#     python shelf_service.py serve --db ebookstore.db --port 8080
+#     python shelf_service.py bench --port 8080 --levels 1,8,32,128
+
+DEFAULT_PORT = 8080
+DEFAULT_SEARCH_LIMIT = 50
+
+# Largest number of queued writes committed in one transaction
+MAX_BATCH = 256
+
+# Largest number of books returned by one search
+MAX_SEARCH_LIMIT = 1000
+
+# Range of an SQLite integer
+SQLITE_INT_MIN = -2 ** 63
+SQLITE_INT_MAX = 2 ** 63 - 1
+
+
+class RequestError(Exception):
+    '''
+    This exception is raised for a request the service cannot carry out.
+    It is returned to the client with the given HTTP status.
+    '''
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _int_field(payload, field):
+    try:
+        value = payload[field]
+    except KeyError:
+        raise RequestError(f"Missing field: {field}")
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise RequestError(f"Field {field} must be a whole number")
+    if not SQLITE_INT_MIN <= value <= SQLITE_INT_MAX:
+        raise RequestError(f"Field {field} is out of range")
+    return value
+
+
+def _str_field(payload, field):
+    value = payload.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise RequestError(f"Field {field} must be a non-empty string")
+    return value.strip()
+
+
+def _summary(row):
+    return {'id': row[0], 'title': row[1], 'author': row[2], 'qty': row[3]}
+
+
+# =========================================================================
+# Database access
+
+
+class ShelfService:
+    '''
+    This class runs the service's reads on a pool of read connections
+    and its writes through one batched writer task.
+    '''
+
+    def __init__(self, database, readers=4, max_batch=MAX_BATCH):
+        self.database = database
+        self.max_batch = max_batch
+        self.read_pool = ThreadPoolExecutor(readers,
+                                            thread_name_prefix='reader')
+        # One thread owns the writer connection
+        self.write_pool = ThreadPoolExecutor(1, thread_name_prefix='writer')
+        self._local = threading.local()
+        self._queue = None
+        self._writer_task = None
+        self._writer_db = None
+        self.batches = 0
+        self.batched_writes = 0
+
+    # ---------------------------------------------------------------------
+    # Start and stop
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.write_pool, self._open_writer)
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.write_pool, self._writer_db.close)
+        self.read_pool.shutdown()
+        self.write_pool.shutdown()
+
+    def _open_writer(self):
+        # isolation_level=None: transactions are opened explicitly, one
+        # per batch. WAL lets the readers carry on while a batch commits.
+        db = sqlite3.connect(self.database, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        create_schema(db.cursor())
+        self._writer_db = db
+
+    def _reader(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True)
+            self._local.db = db
+        return db
+
+    # ---------------------------------------------------------------------
+    # Reads
+
+    async def read(self, op, payload):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.read_pool, op, payload)
+
+    def search(self, payload):
+        limit = payload.get('limit', DEFAULT_SEARCH_LIMIT)
+        if (not isinstance(limit, int) or isinstance(limit, bool)
+                or not 1 <= limit <= MAX_SEARCH_LIMIT):
+            raise RequestError(f"Field limit must be a number from 1 to "
+                               f"{MAX_SEARCH_LIMIT}")
+        if 'author' in payload:
+            query = SQL['search_books_by_author_name']
+            text = payload['author']
+        else:
+            query = SQL['search_books_by_title']
+            text = payload.get('title', '')
+        if not isinstance(text, str):
+            raise RequestError("Search text must be a string")
+        cursor = self._reader().execute(query, ('%' + text + '%',))
+        books = [_summary(row) for row in cursor.fetchmany(limit)]
+        cursor.close()
+        return {'books': books}
+
+    def lookup(self, payload):
+        book_id = _int_field(payload, 'id')
+        cursor = self._reader().execute(SQL['book_detail_by_id'],
+                                        (book_id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise RequestError(f"No book found with id {book_id}", 404)
+        return {'id': row[0], 'title': row[1], 'author_id': row[2],
+                'author': row[3], 'country': row[4], 'qty': row[5]}
+
+    # ---------------------------------------------------------------------
+    # Writes
+
+    async def write(self, op, payload):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((op, payload, future))
+        return await future
+
+    async def _writer(self):
+        '''
+        This function is the writer task. It waits for a write, takes
+        every other write already queued (up to max_batch) and commits
+        them together.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(
+                    self.write_pool, self._apply_batch, batch)
+            except Exception as e:  # the whole transaction failed
+                results = [(False, e)] * len(batch)
+            self.batches += 1
+            self.batched_writes += len(batch)
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue  # the client has gone away
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _apply_batch(self, batch):
+        db = self._writer_db
+        cursor = db.cursor()
+        results = []
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for op, payload, _ in batch:
+                cursor.execute('SAVEPOINT request')
+                try:
+                    results.append((True, op(cursor, payload)))
+                    cursor.execute('RELEASE request')
+                except Exception as e:
+                    # Only this request is undone, the rest of the batch
+                    # is still committed
+                    cursor.execute('ROLLBACK TO request')
+                    cursor.execute('RELEASE request')
+                    results.append((False, e))
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return results
+
+    @staticmethod
+    def adjust_stock(cursor, payload):
+        book_id = _int_field(payload, 'id')
+        delta = _int_field(payload, 'delta')
+        cursor.execute(SQL['adjust_book_qty'], (delta, book_id))
+        if cursor.rowcount == 0:
+            raise RequestError(f"No book found with id {book_id}", 404)
+        cursor.execute(SQL['book_by_id'], (book_id,))
+        return {'id': book_id, 'qty': cursor.fetchone()[3]}
+
+    @staticmethod
+    def add_book(cursor, payload):
+        book_id = _int_field(payload, 'id')
+        title = _str_field(payload, 'title')
+        qty = _int_field(payload, 'qty')
+        author_id = _int_field(payload, 'author_id')
+        cursor.execute(SQL['author_by_id'], (author_id,))
+        if cursor.fetchone() is None:
+            # A new author needs a name and country
+            cursor.execute(SQL['insert_author'],
+                           (author_id, _str_field(payload, 'name'),
+                            _str_field(payload, 'country')))
+        try:
+            cursor.execute(SQL['insert_book'],
+                           (book_id, title, author_id, qty))
+        except sqlite3.IntegrityError:
+            raise RequestError(f"Book id {book_id} is already assigned", 409)
+        return {'id': book_id}
+
+    @staticmethod
+    def delete_book(cursor, payload):
+        book_id = _int_field(payload, 'id')
+        cursor.execute(SQL['book_by_id'], (book_id,))
+        book = cursor.fetchone()
+        if book is None:
+            raise RequestError(f"No book found with id {book_id}", 404)
+        cursor.execute(SQL['delete_book'], (book_id,))
+        # Delete the author as well if this was their only book
+        cursor.execute(SQL['delete_orphan_author'], (book[2],))
+        return {'id': book_id, 'author_deleted': cursor.rowcount == 1}
+
+    # ---------------------------------------------------------------------
+    # Request dispatch
+
+    async def handle(self, path, payload):
+        if path == '/search':
+            return await self.read(self.search, payload)
+        if path == '/lookup':
+            return await self.read(self.lookup, payload)
+        if path == '/stock':
+            return await self.write(self.adjust_stock, payload)
+        if path == '/add':
+            return await self.write(self.add_book, payload)
+        if path == '/delete':
+            return await self.write(self.delete_book, payload)
+        raise RequestError(f"Unknown path: {path}", 404)
+
+
+# =========================================================================
+# HTTP server
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            409: 'Conflict', 500: 'Internal Server Error'}
+
+
+def _response(status, body):
+    data = json.dumps(body).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n\r\n")
+    return head.encode('ascii') + data
+
+
+async def _read_request(reader):
+    '''
+    This function reads one HTTP request. It returns (method, path,
+    body), or None when the client has closed the connection.
+    '''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length) if length else b''
+    return method, path, body
+
+
+async def _serve_client(service, reader, writer):
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                break
+            if request is None:
+                break
+            method, path, body = request
+            try:
+                if method != 'POST':
+                    raise RequestError("Use POST with a JSON body")
+                try:
+                    payload = json.loads(body or b'{}')
+                except ValueError:
+                    raise RequestError("Body is not valid JSON")
+                if not isinstance(payload, dict):
+                    raise RequestError("Body must be a JSON object")
+                status, result = 200, await service.handle(path, payload)
+            except RequestError as e:
+                status, result = e.status, {'error': str(e)}
+            except Exception as e:
+                status, result = 500, {'error': f"{type(e).__name__}: {e}"}
+            writer.write(_response(status, result))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(database, host, port, readers):
+    service = ShelfService(database, readers=readers)
+    await service.start()
+    server = await asyncio.start_server(
+        lambda r, w: _serve_client(service, r, w), host, port)
+    print(f"Serving {database} on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+        if service.batches:
+            print(f"{service.batched_writes} writes committed in "
+                  f"{service.batches} transactions.")
+
+
+# =========================================================================
+# Load-test client
+
+
+async def _call(reader, writer, path, payload):
+    data = json.dumps(payload).encode('utf-8')
+    writer.write(f"POST {path} HTTP/1.1\r\nContent-Type: application/json"
+                 f"\r\nContent-Length: {len(data)}\r\n\r\n".encode('ascii')
+                 + data)
+    await writer.drain()
+    status_line = await reader.readline()
+    length = 0
+    while True:
+        header = await reader.readline()
+        if header in (b'\r\n', b''):
+            break
+        name, _, value = header.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length)
+    return int(status_line.split()[1]), json.loads(body)
+
+
+async def _client(host, port, book_ids, requests, write_ratio, seed,
+                  latencies):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for _ in range(requests):
+            if rng.random() < write_ratio:
+                # Sell a copy and restock it, so stock levels stay put
+                path = '/stock'
+                payload = {'id': rng.choice(book_ids),
+                           'delta': rng.choice((-1, 1))}
+            elif rng.random() < 0.8:
+                path, payload = '/lookup', {'id': rng.choice(book_ids)}
+            else:
+                path = '/search'
+                payload = {'title': rng.choice('aeiou'), 'limit': 10}
+            start = time.perf_counter()
+            await _call(reader, writer, path, payload)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def bench(host, port, levels, requests, write_ratio):
+    '''
+    This function runs the load test at each concurrency level and
+    prints the latency percentiles and throughput.
+    '''
+    reader, writer = await asyncio.open_connection(host, port)
+    _, result = await _call(reader, writer, '/search',
+                            {'title': '', 'limit': 1000})
+    writer.close()
+    book_ids = [book['id'] for book in result['books']]
+    if not book_ids:
+        print("No books to test with.")
+        return
+
+    print(f"{requests} requests per level, {write_ratio:.0%} stock writes")
+    print("clients :   req/s  :  p50 ms  :  p99 ms")
+    for clients in levels:
+        latencies = []
+        per_client = max(requests // clients, 1)
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            _client(host, port, book_ids, per_client, write_ratio, seed,
+                    latencies)
+            for seed in range(clients)))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        print(f"{clients:7d} : {len(latencies) / elapsed:8.0f} : "
+              f"{_percentile(latencies, 0.50) * 1000:8.2f} : "
+              f"{_percentile(latencies, 0.99) * 1000:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='JSON service and load test for ebookstore.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_cmd = commands.add_parser('serve', help='run the JSON service')
+    serve_cmd.add_argument('--db', default='ebookstore.db')
+    serve_cmd.add_argument('--host', default='127.0.0.1')
+    serve_cmd.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_cmd.add_argument('--readers', type=int, default=4)
+    bench_cmd = commands.add_parser('bench', help='run the load test')
+    bench_cmd.add_argument('--host', default='127.0.0.1')
+    bench_cmd.add_argument('--port', type=int, default=DEFAULT_PORT)
+    bench_cmd.add_argument('--levels', default='1,4,16,64',
+                           help='comma separated numbers of clients')
+    bench_cmd.add_argument('--requests', type=int, default=4000,
+                           help='requests per concurrency level')
+    bench_cmd.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'serve':
+            asyncio.run(serve(args.db, args.host, args.port, args.readers))
+        else:
+            levels = [int(level) for level in args.levels.split(',')]
+            asyncio.run(bench(args.host, args.port, levels, args.requests,
+                              args.write_ratio))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
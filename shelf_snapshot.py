@@ -0,0 +1,485 @@
+# Import libraries
+import argparse
+import gzip
+import mmap
+import os
+import random
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left
+
+from shelf_import import parse_stock_line
+from shelf_queries import SCHEMA, SQL
+from shelf_records import Author, Book
+
+# =========================================================================
+# Binary catalog snapshots
+#
+# A snapshot holds the book and author tables in columns: fixed-width
+# numbers, plus one heap of UTF-8 text addressed by offsets. Opening a
+# snapshot maps the file with mmap and reads the columns through
+# memoryviews, so nothing is parsed or copied until a value is used.
+# Books and authors are stored in id order, so a book is found by
+# binary search on the id column.
+#
+# File layout, all numbers little-endian:
+#     header     magic, number of books, number of authors, heap bytes
+#                and the type code of each number column
+#     book id    integer per book, ascending
+#     authorID   integer per book
+#     qty        integer per book
+#     author id  integer per author, ascending
+#     title      uint32 heap offset per book, then the end offset
+#     name       uint32 heap offset per author, then the end offset
+#     country    uint32 heap offset per author, then the end offset
+#     heap       the titles, then the names, then the countries
+# A number column is int32 (type code 'i') if all its values fit, and
+# int64 ('q') otherwise. NULL text is stored as an empty string, and
+# numbers must not be NULL.
+#
+# Write a snapshot, load it into a new database, or compare it with the
+# text stock format:
+#     python shelf_snapshot.py write ebookstore.db catalog.snap
+#     python shelf_snapshot.py load catalog.snap fresh.db
+#     python shelf_snapshot.py bench --books 1000000
+
+MAGIC = b'SHELFSN1'
+HEADER = struct.Struct('<8sQQQ4s4x')
+
+# Text offsets are uint32, so the heap must be smaller than 4 GiB
+MAX_HEAP_BYTES = 2 ** 32 - 1
+
+
+class _TextColumn:
+    '''
+    This class collects the UTF-8 text of one column and the end offset
+    of each value.
+    '''
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('I')
+
+    def append(self, text):
+        self.data += (text or '').encode('utf-8')
+        if len(self.data) > MAX_HEAP_BYTES:
+            raise ValueError("Snapshot text is larger than 4 GiB")
+        self.ends.append(len(self.data))
+
+    def offsets(self, base):
+        '''
+        This function returns the heap offsets of the column when its
+        text starts at base in the heap.
+        '''
+        if base + len(self.data) > MAX_HEAP_BYTES:
+            raise ValueError("Snapshot text is larger than 4 GiB")
+        return array('I', [base] + [base + end for end in self.ends])
+
+
+def _narrow(column):
+    '''
+    This function returns an int64 column as int32 if all values fit.
+    '''
+    if not column or (min(column) >= -2 ** 31 and max(column) < 2 ** 31):
+        return array('i', column)
+    return column
+
+
+def _write_column(file, column):
+    if sys.byteorder == 'big':
+        column.byteswap()
+    file.write(column.tobytes())
+
+
+def write_snapshot(db, filepath):
+    '''
+    This function saves the book and author tables of a database as a
+    snapshot file. It returns the number of books saved.
+    '''
+    cursor = db.cursor()
+    cursor.row_factory = None
+    book_ids, author_refs, qtys = array('q'), array('q'), array('q')
+    titles = _TextColumn()
+    cursor.execute(SQL['snapshot_books'])
+    for book_id, title, author_id, qty in cursor:
+        book_ids.append(book_id)
+        author_refs.append(author_id)
+        qtys.append(qty)
+        titles.append(title)
+
+    author_ids = array('q')
+    names, countries = _TextColumn(), _TextColumn()
+    cursor.execute(SQL['snapshot_authors'])
+    for author_id, name, country in cursor:
+        author_ids.append(author_id)
+        names.append(name)
+        countries.append(country)
+    cursor.close()
+
+    numbers = [_narrow(column)
+               for column in (book_ids, author_refs, qtys, author_ids)]
+    codes = ''.join(column.typecode for column in numbers).encode('ascii')
+    heap_bytes = len(titles.data) + len(names.data) + len(countries.data)
+    with open(filepath, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, len(book_ids), len(author_ids),
+                               heap_bytes, codes))
+        for column in (*numbers,
+                       titles.offsets(0),
+                       names.offsets(len(titles.data)),
+                       countries.offsets(len(titles.data)
+                                         + len(names.data))):
+            _write_column(file, column)
+        for column in (titles, names, countries):
+            file.write(column.data)
+    return len(book_ids)
+
+
+def is_snapshot(filepath):
+    '''
+    This function returns True if the file starts like a snapshot.
+    '''
+    try:
+        with open(filepath, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class Snapshot:
+    '''
+    This class reads a snapshot file through mmap. Columns are
+    memoryviews of the mapped file: book_ids, book_author_ids,
+    book_qtys and author_ids. Use it in a with block, or call close().
+    '''
+
+    def __init__(self, filepath):
+        if sys.byteorder != 'little':
+            raise ValueError("Snapshots can only be mapped on "
+                             "little-endian machines")
+        with open(filepath, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < HEADER.size:
+                raise ValueError(f"{filepath} is not a catalog snapshot")
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.book_count, self.author_count, heap_bytes, codes = \
+            HEADER.unpack_from(self._map)
+        codes = codes.decode('ascii', 'replace')
+        if magic != MAGIC or not set(codes) <= {'i', 'q'}:
+            self._map.close()
+            raise ValueError(f"{filepath} is not a catalog snapshot")
+
+        books, authors = self.book_count, self.author_count
+        width = {'i': 4, 'q': 8}
+        layout = [(code, width[code] * count)
+                  for code, count in zip(codes, (books, books, books,
+                                                 authors))]
+        layout += [('I', 4 * (books + 1)), ('I', 4 * (authors + 1)),
+                   ('I', 4 * (authors + 1)), ('B', heap_bytes)]
+        if HEADER.size + sum(size for _, size in layout) != len(self._map):
+            self._map.close()
+            raise ValueError(f"{filepath} is not a complete snapshot")
+
+        view = memoryview(self._map)
+        self._views = [view]
+        position = HEADER.size
+        for fmt, size in layout:
+            self._views.append(view[position:position + size].cast(fmt))
+            position += size
+        (self.book_ids, self.book_author_ids, self.book_qtys,
+         self.author_ids, self._title_offsets, self._name_offsets,
+         self._country_offsets, self._heap) = self._views[1:]
+
+        # The text columns must follow each other through the heap
+        end = 0
+        for offsets in (self._title_offsets, self._name_offsets,
+                        self._country_offsets):
+            if offsets[0] != end or offsets[-1] < end:
+                self.close()
+                raise ValueError(f"{filepath} is not a complete snapshot")
+            end = offsets[-1]
+        if end != heap_bytes:
+            self.close()
+            raise ValueError(f"{filepath} is not a complete snapshot")
+
+    def __len__(self):
+        return self.book_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # The mapping can only be closed once no memoryview uses it
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._map.close()
+
+    def _text(self, offsets, i):
+        return str(self._heap[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def _texts(self, offsets):
+        '''
+        This function yields every value of a text column in order.
+        '''
+        start, end = offsets[0], offsets[len(offsets) - 1]
+        text = str(self._heap[start:end], 'utf-8')
+        if len(text) == end - start:
+            # ASCII only, so the byte offsets are also string offsets
+            for i in range(len(offsets) - 1):
+                yield text[offsets[i] - start:offsets[i + 1] - start]
+        else:
+            for i in range(len(offsets) - 1):
+                yield self._text(offsets, i)
+
+    def _find(self, ids, record_id):
+        i = bisect_left(ids, record_id)
+        if i < len(ids) and ids[i] == record_id:
+            return i
+        return None
+
+    def book(self, book_id):
+        '''
+        This function returns the Book with the given id, or None.
+        '''
+        i = self._find(self.book_ids, book_id)
+        if i is None:
+            return None
+        return Book(book_id, self._text(self._title_offsets, i),
+                    self.book_author_ids[i], self.book_qtys[i])
+
+    def author(self, author_id):
+        '''
+        This function returns the Author with the given id, or None.
+        '''
+        i = self._find(self.author_ids, author_id)
+        if i is None:
+            return None
+        return Author(author_id, self._text(self._name_offsets, i),
+                      self._text(self._country_offsets, i))
+
+    def book_rows(self):
+        '''
+        This function yields (id, title, authorID, qty) tuples in id order.
+        '''
+        return zip(self.book_ids, self._texts(self._title_offsets),
+                   self.book_author_ids, self.book_qtys)
+
+    def author_rows(self):
+        '''
+        This function yields (id, name, country) tuples in id order.
+        '''
+        return zip(self.author_ids, self._texts(self._name_offsets),
+                   self._texts(self._country_offsets))
+
+
+def bulk_load(db, book_rows, author_rows=()):
+    '''
+    This function inserts rows into the book and author tables in one
+    transaction. Rows whose id is already in the database are skipped.
+    On a new database the indexes are created after the rows are in,
+    which is faster than updating them row by row. It returns the number
+    of books inserted. If the rows cannot be read nothing is inserted.
+    '''
+    cursor = db.cursor()
+    try:
+        for statement in SCHEMA:
+            if not statement.upper().startswith('CREATE INDEX'):
+                cursor.execute(statement)
+        cursor.executemany(SQL['insert_author_if_new'], author_rows)
+        before = db.total_changes
+        cursor.executemany(SQL['insert_book_if_new'], book_rows)
+        inserted = db.total_changes - before
+        for statement in SCHEMA:
+            if statement.upper().startswith('CREATE INDEX'):
+                cursor.execute(statement)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        cursor.close()
+    return inserted
+
+
+def load_snapshot(db, filepath):
+    '''
+    This function loads the books and authors of a snapshot into a
+    database. It returns the number of books inserted, which leaves out
+    books whose id was already in the database.
+    '''
+    with Snapshot(filepath) as snapshot:
+        return bulk_load(db, snapshot.book_rows(), snapshot.author_rows())
+
+
+# =========================================================================
+# Benchmark
+
+
+def _stock_rows(lines):
+    for line in lines:
+        row = parse_stock_line(line)
+        if row is not None:
+            yield row
+
+
+def _write_stock_file(db, file):
+    # Same format as export_books_to_file()
+    file.write("# Book data exported from ebookstore.db\n")
+    file.write("# Format: id,title,authorID,qty\n")
+    for row in db.execute(SQL['export_books']):
+        file.write(f"{row[0]},{row[1]},{row[2]},{row[3]}\n")
+
+
+def _time_format(label, path, directory, read, load):
+    '''
+    This function times reading all the rows of a file, and loading it
+    into a new database file. It returns the load time.
+    '''
+    start = time.perf_counter()
+    read()
+    read_time = time.perf_counter() - start
+
+    db_path = os.path.join(directory, 'load.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    load(db)
+    load_time = time.perf_counter() - start
+    db.close()
+    print(f"{label:<10} : {os.path.getsize(path) / 2 ** 20:7.1f} MB : "
+          f"{read_time:6.2f} s : {load_time:6.2f} s")
+    return load_time
+
+
+def benchmark(books, directory):
+    '''
+    This function writes a generated catalog as a stock file, a gzip
+    stock file and a snapshot, and compares their size and the time to
+    load each into a new database.
+    '''
+    authors = max(books // 10, 1)
+    rng = random.Random(0)
+    source = sqlite3.connect(':memory:')
+    bulk_load(source,
+              ((1000 + i, f"Title {rng.random():.12f}",
+                1000 + rng.randrange(authors), rng.randrange(100))
+               for i in range(books)),
+              ((1000 + i, f"Author {i:06d}", f"Country {i % 50}")
+               for i in range(authors)))
+
+    csv_path = os.path.join(directory, 'catalog.txt')
+    gzip_path = os.path.join(directory, 'catalog.txt.gz')
+    snap_path = os.path.join(directory, 'catalog.snap')
+    with open(csv_path, 'w', encoding='utf-8') as file:
+        _write_stock_file(source, file)
+    with gzip.open(gzip_path, 'wt', encoding='utf-8') as file:
+        _write_stock_file(source, file)
+    start = time.perf_counter()
+    write_snapshot(source, snap_path)
+    print(f"Snapshot of {books} books and {authors} authors written in "
+          f"{time.perf_counter() - start:.2f}s")
+    source.close()
+
+    def read_stock(open_file):
+        with open_file() as file:
+            for _ in _stock_rows(file):
+                pass
+
+    def load_stock(open_file):
+        def load(db):
+            with open_file() as file:
+                bulk_load(db, _stock_rows(file))
+        return load
+
+    def read_snapshot():
+        with Snapshot(snap_path) as snapshot:
+            for _ in snapshot.book_rows():
+                pass
+            for _ in snapshot.author_rows():
+                pass
+
+    def open_csv():
+        return open(csv_path, 'r', encoding='utf-8')
+
+    def open_gzip():
+        return gzip.open(gzip_path, 'rt', encoding='utf-8')
+
+    print("Stock files hold books only, the snapshot books and authors")
+    print("format     :    size    :  read    :  load")
+    csv_time = _time_format("stock file", csv_path, directory,
+                            lambda: read_stock(open_csv),
+                            load_stock(open_csv))
+    _time_format("gzip stock", gzip_path, directory,
+                 lambda: read_stock(open_gzip), load_stock(open_gzip))
+    snap_time = _time_format("snapshot", snap_path, directory,
+                             read_snapshot,
+                             lambda db: load_snapshot(db, snap_path))
+    print(f"Snapshot load is {csv_time / snap_time:.1f}x the speed of "
+          f"the stock file. Load includes SQLite inserts and indexes.")
+
+    lookups = 100000
+    with Snapshot(snap_path) as snapshot:
+        ids = [1000 + rng.randrange(books) for _ in range(lookups)]
+        start = time.perf_counter()
+        for book_id in ids:
+            snapshot.book(book_id)
+        elapsed = time.perf_counter() - start
+    print(f"Random access: {elapsed / lookups * 1e6:.2f} us per book "
+          f"lookup by id")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Binary catalog snapshots for ebookstore.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+    write_cmd = commands.add_parser('write', help='save a snapshot')
+    write_cmd.add_argument('database')
+    write_cmd.add_argument('snapshot')
+    load_cmd = commands.add_parser('load',
+                                   help='load a snapshot into a database')
+    load_cmd.add_argument('snapshot')
+    load_cmd.add_argument('database')
+    show_cmd = commands.add_parser('show', help='look up books by id')
+    show_cmd.add_argument('snapshot')
+    show_cmd.add_argument('ids', type=int, nargs='+')
+    bench_cmd = commands.add_parser('bench', help='compare with stock files')
+    bench_cmd.add_argument('--books', type=int, default=1000000)
+    args = parser.parse_args()
+
+    if args.command == 'write':
+        db = sqlite3.connect(args.database)
+        books = write_snapshot(db, args.snapshot)
+        db.close()
+        print(f"Saved {books} books to {args.snapshot}")
+    elif args.command == 'load':
+        db = sqlite3.connect(args.database)
+        start = time.perf_counter()
+        books = load_snapshot(db, args.snapshot)
+        db.close()
+        print(f"Loaded {books} books from {args.snapshot} in "
+              f"{time.perf_counter() - start:.2f}s")
+    elif args.command == 'show':
+        with Snapshot(args.snapshot) as snapshot:
+            for book_id in args.ids:
+                book = snapshot.book(book_id)
+                if book is None:
+                    print(f"No book found with id {book_id}.")
+                    continue
+                author = snapshot.author(book.author_id)
+                print(f"{book.id} : {book.title} : "
+                      f"{author.name if author else book.author_id} : "
+                      f"{book.qty}")
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark(args.books, directory)
+
+
+if __name__ == '__main__':
+    main()
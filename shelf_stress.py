@@ -0,0 +1,356 @@
+# Import libraries
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from shelf_queries import SQL, create_schema
+
+# =========================================================================
+# Multi-writer stress test for ebookstore.db
+#
+# Many clerks and supplier feeds writing to one database file will sooner
+# or later see 'sqlite3.OperationalError: database is locked'. This
+# harness runs a mixed workload from several threads and processes at
+# once, each with its own connection, against a generated catalog:
+#     stock  - update_qty style quantity changes on the catalog books
+#     insert - a new book, with a new author half of the time
+#     delete - delete_book style: delete one of the worker's own books and
+#              its author if no other book has that author
+#     search - title search with LIKE
+# Busy and locked errors are retried with a random backoff. Throughput,
+# errors, retries and latency percentiles are reported per operation, and
+# afterwards the database is checked for orphaned authors, books without
+# an author and lost quantity updates.
+#
+#     python shelf_stress.py --threads 8 --processes 4 --duration 10
+#     python shelf_stress.py --busy-timeout 0 --begin deferred --wal
+
+OPERATIONS = ('stock', 'insert', 'delete', 'search')
+DEFAULT_MIX = {'stock': 50, 'insert': 15, 'delete': 10, 'search': 25}
+
+# Books and authors created by the workers get ids from here upwards,
+# WORKER_ID_SPAN per worker, so they never clash with the catalog or
+# with each other
+WORKER_ID_BASE = 10000000
+WORKER_ID_SPAN = 1000000
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def build_catalog(database, books, authors):
+    '''
+    This function creates a fresh database with a generated catalog in
+    which every author has at least one book.
+    '''
+    if os.path.exists(database):
+        os.remove(database)
+    db = sqlite3.connect(database)
+    create_schema(db.cursor())
+    db.executemany(SQL['insert_author'],
+                   ((1000 + i, f"Author {i}", "Country")
+                    for i in range(authors)))
+    db.executemany(SQL['insert_book'],
+                   ((1000 + i, f"Title {i}", 1000 + i % authors, 100)
+                    for i in range(books)))
+    db.commit()
+    db.close()
+
+
+# =========================================================================
+# Worker
+
+
+class Worker:
+    '''
+    This class runs the mixed workload on one connection and records what
+    it did, so the results can be checked against the database.
+    '''
+
+    def __init__(self, config, worker_id):
+        self.config = config
+        self.rng = random.Random(worker_id)
+        self.next_id = WORKER_ID_BASE + worker_id * WORKER_ID_SPAN
+        # isolation_level=None so each operation opens its own
+        # transaction with the configured BEGIN
+        self.db = sqlite3.connect(config['database'],
+                                  timeout=config['busy_timeout'] / 1000,
+                                  isolation_level=None)
+        self.cursor = self.db.cursor()
+        self.own_books = []
+        self.stats = {op: {'ok': 0, 'failed': 0, 'busy_errors': 0,
+                           'retries': 0, 'latencies': []}
+                      for op in OPERATIONS}
+        self.qty_delta = 0
+        self.books_added = 0
+        self.books_deleted = 0
+
+    def run(self):
+        ops = list(self.config['mix'])
+        weights = [self.config['mix'][op] for op in ops]
+        deadline = time.perf_counter() + self.config['duration']
+        while time.perf_counter() < deadline:
+            op = self.rng.choices(ops, weights)[0]
+            self._run_op(op)
+        self.db.close()
+        return {'stats': self.stats, 'qty_delta': self.qty_delta,
+                'books_added': self.books_added,
+                'books_deleted': self.books_deleted}
+
+    def _run_op(self, op):
+        stats = self.stats[op]
+        action = getattr(self, op)
+        start = time.perf_counter()
+        for attempt in range(self.config['retries'] + 1):
+            if attempt:
+                stats['retries'] += 1
+                # Random backoff, growing with each attempt
+                time.sleep(self.rng.uniform(0, 0.001 * 2 ** attempt))
+            try:
+                applied = self._transaction(action, op == 'search')
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e):
+                    raise
+                stats['busy_errors'] += 1
+                continue
+            applied()
+            stats['ok'] += 1
+            stats['latencies'].append(time.perf_counter() - start)
+            return
+        stats['failed'] += 1
+
+    def _transaction(self, action, read_only):
+        '''
+        This function runs one operation in a transaction. The operation
+        returns a function that records its effect, which is only called
+        once the transaction has committed.
+        '''
+        cursor = self.cursor
+        if read_only:
+            return action(cursor)
+        cursor.execute(f"BEGIN {self.config['begin']}")
+        try:
+            applied = action(cursor)
+            cursor.execute('COMMIT')
+        except BaseException:
+            if self.db.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        return applied
+
+    # ---------------------------------------------------------------------
+    # Operations
+
+    def stock(self, cursor):
+        book_id = 1000 + self.rng.randrange(self.config['books'])
+        delta = self.rng.choice((-1, 1, 2))
+        # Read then write like update_qty() after select_book()
+        cursor.execute(SQL['book_by_id'], (book_id,))
+        qty = cursor.fetchone()[3]
+        cursor.execute(SQL['update_book_qty'], (qty + delta, book_id))
+
+        def applied():
+            self.qty_delta += delta
+        return applied
+
+    def insert(self, cursor):
+        book_id = self.next_id
+        if self.own_books and self.rng.random() < 0.5:
+            # Another book by an author this worker added
+            auth_id = self.rng.choice(self.own_books)[1]
+        else:
+            auth_id = book_id
+            cursor.execute(SQL['insert_author'],
+                           (auth_id, f"Author {auth_id}", "Country"))
+        cursor.execute(SQL['insert_book'],
+                       (book_id, f"Title {book_id}", auth_id, 1))
+
+        def applied():
+            self.next_id += 1
+            self.own_books.append((book_id, auth_id))
+            self.books_added += 1
+        return applied
+
+    def delete(self, cursor):
+        if not self.own_books:
+            return lambda: None
+        index = self.rng.randrange(len(self.own_books))
+        book_id, auth_id = self.own_books[index]
+        # Same steps as delete_book()
+        cursor.execute(SQL['delete_book'], (book_id,))
+        cursor.execute(SQL['count_books_by_author'], (auth_id,))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(SQL['delete_author'], (auth_id,))
+
+        def applied():
+            self.own_books.pop(index)
+            self.books_deleted += 1
+        return applied
+
+    def search(self, cursor):
+        # A cursor of its own, closed so that the unread rows do not
+        # keep the database locked
+        search_cursor = self.db.cursor()
+        search_cursor.execute(SQL['search_books_by_title'],
+                              (f"%{self.rng.randrange(1000)}%",))
+        search_cursor.fetchmany(50)
+        search_cursor.close()
+        return lambda: None
+
+
+def run_worker(config, worker_id):
+    return Worker(config, worker_id).run()
+
+
+# =========================================================================
+# Checks and report
+
+
+def check_invariants(config, results):
+    '''
+    This function checks the database after a run and returns a list of
+    failure messages, empty if every invariant holds.
+    '''
+    db = sqlite3.connect(config['database'])
+    failures = []
+    orphans = db.execute('''
+                SELECT COUNT() FROM author
+                WHERE NOT EXISTS (SELECT 1 FROM book
+                                  WHERE book.authorID = author.id)
+                ''').fetchone()[0]
+    if orphans:
+        failures.append(f"{orphans} authors have no books")
+    missing = db.execute('''
+                SELECT COUNT() FROM book
+                WHERE NOT EXISTS (SELECT 1 FROM author
+                                  WHERE author.id = book.authorID)
+                ''').fetchone()[0]
+    if missing:
+        failures.append(f"{missing} books have no author")
+
+    expected_qty = (100 * config['books']
+                    + sum(result['qty_delta'] for result in results))
+    qty = db.execute('SELECT SUM(qty) FROM book WHERE id < ?',
+                     (WORKER_ID_BASE,)).fetchone()[0]
+    if qty != expected_qty:
+        failures.append(f"Catalog quantity is {qty}, expected "
+                        f"{expected_qty}: updates were lost")
+
+    expected_books = sum(result['books_added'] - result['books_deleted']
+                         for result in results)
+    books = db.execute('SELECT COUNT() FROM book WHERE id >= ?',
+                       (WORKER_ID_BASE,)).fetchone()[0]
+    if books != expected_books:
+        failures.append(f"{books} worker books in the database, "
+                        f"expected {expected_books}")
+    db.close()
+    return failures
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(config, results, elapsed):
+    print(f"{config['threads']} threads, {config['processes']} processes, "
+          f"{config['duration']}s, BEGIN {config['begin']}, "
+          f"busy timeout {config['busy_timeout']} ms")
+    print(" operation :  ok/s  : failed : busy : retries : p50 ms : "
+          "p99 ms : max ms")
+    total_ok = 0
+    for op in OPERATIONS:
+        ok = sum(r['stats'][op]['ok'] for r in results)
+        failed = sum(r['stats'][op]['failed'] for r in results)
+        busy = sum(r['stats'][op]['busy_errors'] for r in results)
+        retries = sum(r['stats'][op]['retries'] for r in results)
+        latencies = sorted(latency for r in results
+                           for latency in r['stats'][op]['latencies'])
+        total_ok += ok
+        print(f"{op:>10} : {ok / elapsed:6.0f} : {failed:6d} : {busy:4d} : "
+              f"{retries:7d} : {_percentile(latencies, 0.5) * 1000:6.2f} : "
+              f"{_percentile(latencies, 0.99) * 1000:6.2f} : "
+              f"{(latencies[-1] if latencies else 0) * 1000:6.1f}")
+    print(f"Total {total_ok / elapsed:.0f} operations/s")
+
+
+def run(config):
+    '''
+    This function builds the catalog, runs all workers at once and
+    returns the list of invariant failures.
+    '''
+    build_catalog(config['database'], config['books'], config['authors'])
+    if config['wal']:
+        db = sqlite3.connect(config['database'])
+        db.execute('PRAGMA journal_mode=WAL')
+        db.close()
+
+    workers = config['threads'] + config['processes']
+    start = time.perf_counter()
+    # Worker processes are spawned rather than forked, as forking while
+    # the worker threads hold locks can leave a child process stuck
+    spawn = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max(config['threads'], 1)) as threads, \
+            ProcessPoolExecutor(max(config['processes'], 1),
+                                mp_context=spawn) as processes:
+        futures = [threads.submit(run_worker, config, worker_id)
+                   for worker_id in range(config['threads'])]
+        futures += [processes.submit(run_worker, config, worker_id)
+                    for worker_id in range(config['threads'], workers)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    report(config, results, elapsed)
+    failures = check_invariants(config, results)
+    if failures:
+        print("Invariant check failed:")
+        for failure in failures:
+            print(f"  {failure}")
+    else:
+        print("Invariants hold: no orphaned authors, no books without "
+              "an author, no lost quantity updates.")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Concurrent write stress test for ebookstore.db')
+    parser.add_argument('--db', default='stress.db',
+                        help='database file, recreated for the run')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--authors', type=int, default=10000)
+    parser.add_argument('--busy-timeout', type=int, default=5000,
+                        help='sqlite3 busy timeout in ms (default 5000, '
+                        'the sqlite3.connect() default the menu uses)')
+    parser.add_argument('--retries', type=int, default=10,
+                        help='retries of a busy operation')
+    parser.add_argument('--begin', choices=('deferred', 'immediate'),
+                        default='immediate',
+                        help='transaction start for write operations')
+    parser.add_argument('--wal', action='store_true',
+                        help='use write-ahead logging')
+    args = parser.parse_args()
+
+    config = {'database': args.db, 'threads': args.threads,
+              'processes': args.processes, 'duration': args.duration,
+              'books': args.books, 'authors': min(args.authors, args.books),
+              'busy_timeout': args.busy_timeout, 'retries': args.retries,
+              'begin': args.begin.upper(), 'wal': args.wal,
+              'mix': DEFAULT_MIX}
+    failures = run(config)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,18 @@
 # Import libraries
+import os
 import sqlite3
+from itertools import chain
+
+import shelf_metrics
+import shelf_profile
+from shelf_autocomplete import AUTHOR, TITLE, PrefixIndex
+from shelf_dedup import CatalogChecker
+from shelf_import import (PARALLEL_IMPORT_BYTES, import_stock_parallel,
+                          parse_stock_line)
+from shelf_queries import SQL, create_schema
+from shelf_records import (Author, Book, BookWithAuthor, fetch_one,
+                           fetch_records)
+from shelf_snapshot import is_snapshot, load_snapshot
 
 # =========================================================================
 # === Functions ===
@@ -21,21 +34,13 @@ def load_stock_from_file(filepath):
     try:
         with open(filepath, 'r', encoding='utf-8') as file:
             for line_num, line in enumerate(file, start=1):
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue  # skip empty lines and comments
                 try:
-                    parts = line.split(',')
-                    if len(parts) != 4:
-                        print(f"Skipping line {line_num}: incorrect format")
-                        continue
-                    book_id = int(parts[0].strip())
-                    title = parts[1].strip()
-                    author_id = int(parts[2].strip())
-                    qty = int(parts[3].strip())
-                    stock.append((book_id, title, author_id, qty))
-                except ValueError:
-                    print(f"Skipping line {line_num}: invalid data")
+                    book = parse_stock_line(line)
+                except ValueError as e:
+                    print(f"Skipping line {line_num}: {e}")
+                    continue
+                if book is not None:
+                    stock.append(book)
         print(f"Loaded {len(stock)} books from {filepath}.")
     except FileNotFoundError:
         print(f"File not found: {filepath}")
@@ -54,17 +59,9 @@ def export_books_to_file(cursor, filepath):
         cursor = database cursor object
         filepath = path where the file should be saved
     '''
-    import os
-
     try:
-        cursor.execute('SELECT id, title, authorID, qty FROM book')
-        books = cursor.fetchall()
-
-        if not books:
-            print("No books in database to export.")
-            return False
-
-        # Check if file exists and get user confirmation
+        # Check if file exists and get user confirmation. This is done
+        # before the query, so no read lock is held while waiting
         if os.path.exists(filepath):
             confirm = input(f"File '{filepath}' already exists. "
                             f"Overwrite? (y/n): ").lower()
@@ -72,14 +69,25 @@ def export_books_to_file(cursor, filepath):
                 print("Export cancelled.")
                 return False
 
+        books = fetch_records(cursor.connection, SQL['export_books'], (),
+                              Book)
+        first_book = next(books, None)
+
+        if first_book is None:
+            print("No books in database to export.")
+            return False
+
         with open(filepath, 'w', encoding='utf-8') as file:
             file.write("# Book data exported from ebookstore.db\n")
             file.write("# Format: id,title,authorID,qty\n")
-            for book in books:
-                line = f"{book[0]},{book[1]},{book[2]},{book[3]}\n"
+            count = 0
+            # Books are written as they are read, without a list of them all
+            for book in chain([first_book], books):
+                line = f"{book.id},{book.title},{book.author_id},{book.qty}\n"
                 file.write(line)
+                count += 1
 
-        print(f"Successfully exported {len(books)} books to {filepath}")
+        print(f"Successfully exported {count} books to {filepath}")
         return True
     except Exception as e:
         print(f"Error exporting books: {e}")
@@ -91,21 +99,8 @@ def initialise_ebookstore_db(cursor):
     This function initialises the tables for ebookstore.db and
     initialises a cursor object for use throughout the program.
     '''
-    # Create book table
-    cursor.execute('''
-                CREATE TABLE IF NOT EXISTS book(
-                id INTEGER PRIMARY KEY,
-                title TEXT,
-                authorID INTEGER,
-                qty INTEGER)
-                ''')
-    # Create author table
-    cursor.execute('''
-                CREATE TABLE IF NOT EXISTS author(
-                id INTEGER PRIMARY KEY,
-                name TEXT,
-                country TEXT)
-                ''')
+    # Create the book and author tables and their indexes
+    create_schema(cursor)
     db.commit()
 
 
@@ -126,12 +121,7 @@ def populate_book_table(cursor, stock=None):
             ]
     # Check if empty
     try:
-        cursor.executemany('''
-                           INSERT INTO book(id, title, authorID, qty)
-                           VALUES(?, ?, ?, ?)
-                           ''',
-                           stock
-                           )
+        cursor.executemany(SQL['insert_book'], stock)
         print("Sample book table populated and loaded.")
         db.commit()
     except sqlite3.IntegrityError:
@@ -153,12 +143,7 @@ def populate_author_table(cursor):
         ]
     # Check if empty
     try:
-        cursor.executemany('''
-                           INSERT INTO author(id, name, country)
-                           VALUES(?, ?, ?)
-                           ''',
-                           author_info
-                           )
+        cursor.executemany(SQL['insert_author'], author_info)
         print("Empty author table populated and loaded.")
         db.commit()
     except sqlite3.IntegrityError:
@@ -181,9 +166,32 @@ Enter 'y' to load from file or any other key to use default data
     custom_stock = None
     if user_choice == 'y':
         filepath = input("Enter the filepath for the book data file: ")
-        custom_stock = load_stock_from_file(filepath)
-        if custom_stock is None:
-            print("Failed to load custom data. Using default data instead.")
+        # Binary snapshots hold books and authors, ready to bulk load
+        if is_snapshot(filepath):
+            try:
+                with shelf_profile.track(profiler, 'load_snapshot'):
+                    books = load_snapshot(db, filepath)
+            except (ValueError, UnicodeDecodeError, OSError) as e:
+                print(f"Error reading snapshot: {e}")
+                print("Failed to load custom data. "
+                      "Using default data instead.")
+            else:
+                print(f"Loaded {books} books from snapshot {filepath}")
+                return
+        else:
+            # Very large files are parsed in parallel and inserted directly
+            if (os.path.isfile(filepath)
+                    and os.path.getsize(filepath) >= PARALLEL_IMPORT_BYTES):
+                with shelf_profile.track(profiler, 'import_stock_parallel'):
+                    imported = import_stock_parallel(db, filepath)
+                if imported is not None:
+                    populate_author_table(cursor)
+                    return
+            with shelf_profile.track(profiler, 'load_stock_from_file'):
+                custom_stock = load_stock_from_file(filepath)
+            if custom_stock is None:
+                print("Failed to load custom data. "
+                      "Using default data instead.")
 
     populate_book_table(cursor, custom_stock)
     populate_author_table(cursor)
@@ -198,16 +206,19 @@ def display_all_books(query_str):
     This function displays a summary of the entire book inventory on
     the screen.
     '''
-    cursor.execute(query_str)
-    book_list = cursor.fetchall()
-
-    # Display the inventory if any books are selected for display
-    if book_list:
-        print("Book inventory")
-        print(" id  : title : author : qty")
-        for book in book_list:
-            print(f"{book[0]} : {book[1]} : {book[2]} : {book[3]}")
-    else:
+    books = fetch_records(db, query_str, (), BookWithAuthor)
+
+    # Display the inventory if any books are selected for display. Books
+    # are printed as they are read, without a list of them all.
+    found = False
+    for book in books:
+        if not found:
+            print("Book inventory")
+            print(" id  : title : author : qty")
+            found = True
+        print(f"{book.id} : {book.title} : {book.author_name} : "
+              f"{book.qty}")
+    if not found:
         print("No books found.")
 
 
@@ -216,16 +227,19 @@ def display_books_cond(query_str, condition):
     This function displays a summary of the book inventory matching a
     condition on the screen.
     '''
-    cursor.execute(query_str, (condition,))
-    book_list = cursor.fetchall()
-
-    # Display the inventory if any books are selected for display
-    if book_list:
-        print("Book inventory")
-        print(" id  : title : author : qty")
-        for book in book_list:
-            print(f"{book[0]} : {book[1]} : {book[2]} : {book[3]}")
-    else:
+    books = fetch_records(db, query_str, (condition,), BookWithAuthor)
+
+    # Display the inventory if any books are selected for display. Books
+    # are printed as they are read, without a list of them all.
+    found = False
+    for book in books:
+        if not found:
+            print("Book inventory")
+            print(" id  : title : author : qty")
+            found = True
+        print(f"{book.id} : {book.title} : {book.author_name} : "
+              f"{book.qty}")
+    if not found:
         print("No books found.")
 
 
@@ -239,36 +253,26 @@ def select_book():
     book id. It returns the selected_bk record.
     '''
     # Display the books
-    query_str = '''
-                SELECT book.id, book.title, author.name, book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                '''
+    query_str = SQL['list_books']
     display_all_books(query_str)
 
     # Get user input and select the corresponding book
     while True:
         try:
             input_id = int(input("Select a book.\nEnter its id number: "))
-            cursor.execute('''
-                   SELECT book.id, book.title,
-                   author.id, author.name, author.country,
-                   book.qty
-                   FROM book INNER JOIN author
-                   ON book.authorID = author.id
-                   WHERE book.id = ?''', (input_id,))
+            selected_bk = fetch_one(db, SQL['book_detail_by_id'],
+                                    (input_id,), BookWithAuthor)
 
             # Display selected book details
-            selected_bk = cursor.fetchone()
             if selected_bk is None:
                 print(f"No book found with id {input_id}. Please try again.")
             else:
                 print(f"Selected book summary\n\nid : title"
-                      f"\n{selected_bk[0]} : {selected_bk[1]}"
+                      f"\n{selected_bk.id} : {selected_bk.title}"
                       f"\n\nauthorID : author name : country"
-                      f"\n{selected_bk[2]} : {selected_bk[3]} : "
-                      f"{selected_bk[4]}"
-                      f"\n\nquantity: {selected_bk[5]}\n"
+                      f"\n{selected_bk.author_id} : "
+                      f"{selected_bk.author_name} : {selected_bk.country}"
+                      f"\n\nquantity: {selected_bk.qty}\n"
                       )
             break  # out of while loop
         except ValueError:
@@ -280,34 +284,30 @@ def select_book():
 # Input field functions
 
 
-def input_title(cursor):
+def input_title():
     '''
-    This function checks if a title is unique. If not, it asks the user
-    if they want to continue with the duplicate title or enter a new
-    one.
+    This function checks if a title is unique. If the title or a near
+    duplicate of it (eg 'Lord of the Rings, The' for 'The Lord of the
+    Rings') already exists, it asks the user if they want to continue
+    with the duplicate title or enter a new one.
     '''
     bk_title = input("Title: ")
     # Check the entered title is unique
-    cursor.execute('''
-                SELECT book.id, book.title,
-                author.id, author.name, author.country,
-                book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                WHERE book.id = ?''', (bk_title,))
-    test_unique = cursor.fetchone()
-
-    if test_unique is not None:  # Title is a duplicate
-        print(f"A book with {bk_title} already exists."
-              f"\nEnter 'y' to accept this title or any other key "
-              f"to try again.")
+    similar_titles = title_checker.similar(bk_title)
+
+    if similar_titles:  # Title is a duplicate
+        print(f"A book with a title like {bk_title} already exists.")
+        for bk_id, existing_title, _ in similar_titles:
+            print(f"{bk_id} : {existing_title}")
+        print("Enter 'y' to accept this title or any other key "
+              "to try again.")
         confirm_existing_title = input(": ")
         # Allow for upper or lower case input while avoiding exceptions
         # if the user doesn't input a letter.
         if confirm_existing_title == 'y' or confirm_existing_title == 'Y':
             return bk_title
         else:
-            input_title(cursor)
+            return input_title()
 
     else:  # Title is unique
         return bk_title
@@ -330,14 +330,10 @@ def input_book_id(cursor):
             print("Please enter a four digit number greater than 999.")
 
     # Check the entered id is unique
-    cursor.execute('''
-                SELECT *
-                FROM book
-                WHERE book.id = ?''', (bk_id,))
-    test_unique = cursor.fetchone()
+    test_unique = fetch_one(db, SQL['book_by_id'], (bk_id,), Book)
 
     if test_unique is not None:  # id is a duplicate
-        print(f"Book id {bk_id} is assigned to {test_unique[1]}."
+        print(f"Book id {bk_id} is assigned to {test_unique.title}."
               f"\nPlease try again.")
         input_book_id(cursor)
     else:  # id is unqiue
@@ -348,32 +344,29 @@ def input_author_id(cursor):
     '''
     This function checks if an authorID is a four digit number and is
     unique. If not, it asks the user if they want to continue with the
-    repeated author or enter a new one.
+    repeated author or enter a new one. If the user types the start of
+    an author name instead of a number, the matching authors and their
+    ids are listed.
     '''
     # Check the entered authorID is a four digit number
     while True:
+        auth_input = input("authorID (or the start of an author name): ")
         try:
-            auth_id = int(input("authorID: "))
+            auth_id = int(auth_input)
             if auth_id >= 1000 and auth_id <= 9999:
                 break  # out of while loop
             else:
                 print("Please enter a four digit number greater than 999.")
         except ValueError:
-            print("Please enter a four digit number greater than 999.")
+            show_author_matches(auth_input)
 
     # Check the entered authorID is unique
-    cursor.execute('''
-                SELECT book.id, book.title,
-                author.id, author.name, author.country,
-                book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                WHERE author.id = ?''', (auth_id,))
-    test_unique = cursor.fetchone()
+    test_unique = fetch_one(db, SQL['book_detail_by_author_id'], (auth_id,),
+                            BookWithAuthor)
 
     # Allow for the case where an author has written more than one book.
     if test_unique is not None:  # authorID is a duplicate
-        print(f"authorID {auth_id} is assigned to {test_unique[3]}."
+        print(f"authorID {auth_id} is assigned to {test_unique.author_name}."
               f"\nEnter 'y' to accept this author or any other key "
               f"to try again.")
         confirm_existing_author = input(": ")
@@ -390,28 +383,36 @@ def input_author_id(cursor):
         return auth_id
 
 
+def show_author_matches(prefix):
+    '''
+    This function lists the authors whose name starts with prefix, so the
+    user can find an existing authorID. It is called by input_author_id().
+    '''
+    matches = catalog_index.complete_authors(prefix)
+    if matches:
+        print("Matching authors\nauthorID : author name")
+        for auth_id, auth_name in matches:
+            print(f"{auth_id} : {auth_name}")
+    else:
+        print("No matching authors. "
+              "Please enter a four digit number greater than 999.")
+
+
 def input_author_details(cursor, auth_id):
     '''
     This function checks if a valid authorID is linked to name and country.
-    If there is a link, the author data is returned: author_data = [authorID,
-    name, country]. If there isn't a link, the user is asked to input
-    name and country to complete author_data.
+    If there is a link, the Author record is returned. If there isn't a
+    link, the user is asked to input name and country to complete the
+    Author record.
     '''
     # Count the records in book table containing auth_id
-    cursor.execute('''
-                   SELECT COUNT()
-                   FROM book
-                   WHERE book.authorID = ?''',
+    cursor.execute(SQL['count_books_by_author'],
                    (auth_id,)
                    )
     auth_count = cursor.fetchone()
 
     # Get the author information
-    cursor.execute('''
-                    SELECT author.id, author.name, author.country
-                    FROM author
-                    WHERE author.id = ?''', (auth_id,))
-    author_data = cursor.fetchone()
+    author_data = fetch_one(db, SQL['author_by_id'], (auth_id,), Author)
 
     # authorID is created by input_author_id, which has checked the authorID
     # is unique or assigned to an existing author. If the authorID is unique
@@ -420,14 +421,41 @@ def input_author_details(cursor, auth_id):
     # is 0, ask the user to input name and country. Otherwise, return
     # the existing record in author_data.
     if auth_count[0] == 0:
-        author_data = []
-        author_data.append(auth_id)
-        author_data.append(input("Author name: "))
-        author_data.append(input("Author country: "))
+        author_data = Author(auth_id)
+        author_data.name = input_author_name()
+        author_data.country = input("Author country: ")
     # else the author exists and return the existing complete record
     return author_data
 
 
+def input_author_name():
+    '''
+    This function asks for the name of a new author. If the name or a
+    near duplicate of it (eg 'Tolkien, J. R. R.' for 'J.R.R. Tolkien')
+    already exists, the matching authors and their ids are listed and
+    the user is asked to confirm the name or enter it again.
+    '''
+    auth_name = input("Author name: ")
+    similar_authors = author_checker.similar(auth_name)
+
+    if similar_authors:  # Name is a duplicate
+        print(f"An author with a name like {auth_name} already exists.")
+        for auth_id, existing_name, _ in similar_authors:
+            print(f"{auth_id} : {existing_name}")
+        print("Enter 'y' to accept this name or any other key "
+              "to try again.")
+        confirm_existing_name = input(": ")
+        # Allow for upper or lower case input while avoiding exceptions
+        # if the user doesn't input a letter.
+        if confirm_existing_name == 'y' or confirm_existing_name == 'Y':
+            return auth_name
+        else:
+            return input_author_name()
+
+    else:  # Name is unique
+        return auth_name
+
+
 def input_book_qty():
     '''
     This function asks the user to enter a qty and checks the input is
@@ -456,41 +484,38 @@ def enter_book():
           "\nPlease enter the book information."
           )
     # Call input functions
-    bk_title = input_title(cursor)
+    bk_title = input_title()
     bk_qty = input_book_qty()
     bk_id = input_book_id(cursor)
     auth_id = input_author_id(cursor)
     author_data = input_author_details(cursor, auth_id)
-    # Extract fields from the list returned by author_data
-    auth_name = author_data[1]
-    auth_country = author_data[2]
+    # Extract fields from the Author record
+    auth_name = author_data.name
+    auth_country = author_data.country
 
     # Insert the new book record into the database
-    cursor.execute('''
-                   INSERT INTO book(id, title, authorID, qty)
-                   VALUES (?, ?, ?, ?)''',
+    cursor.execute(SQL['insert_book'],
                    (bk_id, bk_title, auth_id, bk_qty)
                    )
     db.commit()
+    catalog_index.add(TITLE, bk_id, bk_title)
+    title_checker.add(bk_id, bk_title)
     print(f"{bk_title} entered into database.")
 
     # Insert a new author record into the database, unless the author
     # already exists.
     try:
-        cursor.execute('''
-                    INSERT INTO author(id, name, country)
-                    VALUES (?, ?, ?)''', (auth_id, auth_name, auth_country))
+        cursor.execute(SQL['insert_author'],
+                       (auth_id, auth_name, auth_country))
         db.commit()
+        catalog_index.add(AUTHOR, auth_id, auth_name)
+        author_checker.add(auth_id, auth_name)
         print(f"{auth_name} entered into database.")
     except sqlite3.IntegrityError:
         print("Author information confirmed present in database.")
 
     # Display updated book inventory
-    query_str = '''
-                SELECT book.id, book.title, author.name, book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                '''
+    query_str = SQL['list_books']
     display_all_books(query_str)
 
 
@@ -504,11 +529,11 @@ def update_title(selected_bk):
     called by update_book(). Duplicate titles are allowed.
     '''
     input_title = input("Enter the updated title: ")
-    cursor.execute('''
-                    UPDATE book SET title = ?
-                    WHERE id = ?''', (input_title, selected_bk[0]))
+    cursor.execute(SQL['update_book_title'], (input_title, selected_bk.id))
     db.commit()
-    print(f"Title of book {selected_bk[0]} updated to:\n{input_title}.")
+    catalog_index.add(TITLE, selected_bk.id, input_title)
+    title_checker.add(selected_bk.id, input_title)
+    print(f"Title of book {selected_bk.id} updated to:\n{input_title}.")
 
 
 def update_auth_name(selected_bk):
@@ -523,37 +548,31 @@ def update_auth_name(selected_bk):
 
     updated_name = input("Enter the updated author name: ")
     # Check updated_name is unique
-    cursor.execute('''
-                SELECT book.id, book.title,
-                author.id, author.name, author.country,
-                book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                WHERE author.name = ?''', (updated_name,))
-    test_unique = cursor.fetchone()
+    test_unique = fetch_one(db, SQL['book_detail_by_author_name'],
+                            (updated_name,), BookWithAuthor)
 
     # Allow for the case where an author has written more than one book.
     if test_unique is not None:  # the author already exists
         print(f"{updated_name} already exists in the database.")
-        auth_country = test_unique[4]
+        auth_country = test_unique.country
         print(f"{updated_name}'s country is {auth_country}.")
 
         # Update the book record to have the existing authorID
         # and repopulate the author information
-        selected_auth_id = test_unique[2]
-        cursor.execute('''
-                        UPDATE book SET authorID = ?
-                        WHERE id = ?''', (selected_auth_id, selected_bk[0]))
+        selected_auth_id = test_unique.author_id
+        cursor.execute(SQL['update_book_author'],
+                       (selected_auth_id, selected_bk.id))
         db.commit()
 
     else:  # the author is unique
-        selected_auth_id = selected_bk[2]
-        cursor.execute('''
-                       UPDATE author SET name = ?
-                       WHERE id = ?''', (updated_name, selected_auth_id))
+        selected_auth_id = selected_bk.author_id
+        cursor.execute(SQL['update_author_name'],
+                       (updated_name, selected_auth_id))
         db.commit()
+        catalog_index.add(AUTHOR, selected_auth_id, updated_name)
+        author_checker.add(selected_auth_id, updated_name)
 
-    print(f"Author of book {selected_bk[1]} "
+    print(f"Author of book {selected_bk.title} "
           f"updated to\n{updated_name}.")
 
 
@@ -562,13 +581,10 @@ def update_author(selected_bk):
     This function updates the author information of a book based on
     user input. It is called by update_book().
     '''
-    selected_auth_id = selected_bk[2]  # authorID
+    selected_auth_id = selected_bk.author_id  # authorID
 
     # Count the records in book containing selected_auth_id
-    cursor.execute('''
-                SELECT COUNT()
-                FROM book
-                WHERE book.authorID = ?''', (selected_auth_id,))
+    cursor.execute(SQL['count_books_by_author'], (selected_auth_id,))
     auth_count = cursor.fetchone()
 
     # If the author appears against more than one book ask if the
@@ -601,11 +617,10 @@ or any other key to go back to the main menu
 
         elif update_author_menu == '2':
             updated_country = input("Enter the updated author country: ")
-            cursor.execute('''
-                        UPDATE author SET country = ?
-                        WHERE id = ?''', (updated_country, selected_auth_id))
+            cursor.execute(SQL['update_author_country'],
+                           (updated_country, selected_auth_id))
             db.commit()
-            print(f"Author country of book {selected_bk[1]} "
+            print(f"Author country of book {selected_bk.title} "
                   f"updated to\n{updated_country}.")
         else:
             break  # out of while loop
@@ -616,11 +631,9 @@ def update_qty(input_qty, selected_bk):
     This function updates the quantity of a book based on user input.
     It is called by update_book().
     '''
-    cursor.execute('''
-                    UPDATE book SET qty = ?
-                    WHERE ID = ?''', (input_qty, selected_bk[0]))
+    cursor.execute(SQL['update_book_qty'], (input_qty, selected_bk.id))
     db.commit()
-    print(f"Quantity of book {selected_bk[1]} updated to\n{input_qty}.")
+    print(f"Quantity of book {selected_bk.title} updated to\n{input_qty}.")
 
 
 def update_book():
@@ -673,9 +686,9 @@ def delete_book():
         selected_bk = select_book()
         # Get book information
         if selected_bk is not None:
-            selected_bk_id = selected_bk[0]
-            selected_auth_id = selected_bk[2]
-            selected_author = selected_bk[3]
+            selected_bk_id = selected_bk.id
+            selected_auth_id = selected_bk.author_id
+            selected_author = selected_bk.author_name
         else:  # book does not exist
             print("No books found")
             break  # out of while loop
@@ -687,21 +700,17 @@ def delete_book():
         # if the user doesn't input a letter.
         if confirm == 'y' or confirm == 'Y':
             cursor = db.cursor()
-            cursor.execute('''
-                        DELETE FROM book WHERE id = ?''', (selected_bk_id,))
-            output_str = f"{selected_bk_id} {selected_bk[1]} deleted."
+            cursor.execute(SQL['delete_book'], (selected_bk_id,))
+            output_str = f"{selected_bk_id} {selected_bk.title} deleted."
 
             # Delete the author information if the author is unique.
             # Uses sqlite COUNT (Geeks for geeks, 2023b)
-            cursor.execute('''
-                            SELECT COUNT(book.authorID)
-                            FROM book
-                            WHERE authorID = ?''', (selected_auth_id,))
+            cursor.execute(SQL['count_books_by_author'],
+                           (selected_auth_id,))
             author_count = cursor.fetchone()
 
             if author_count[0] == 0:  # author is unique
-                cursor.execute('''
-                            DELETE FROM author WHERE id = ?''',
+                cursor.execute(SQL['delete_author'],
                                (selected_auth_id,))
                 output_str += f"\n{selected_author} deleted."
 
@@ -710,14 +719,15 @@ def delete_book():
                 output_str += "the database."
 
             db.commit()
+            catalog_index.remove(TITLE, selected_bk_id)
+            title_checker.remove(selected_bk_id)
+            if author_count[0] == 0:
+                catalog_index.remove(AUTHOR, selected_auth_id)
+                author_checker.remove(selected_auth_id)
             print(output_str)
 
             # Display updated inventory
-            query_str = '''
-                SELECT book.id, book.title, author.name, book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                '''
+            query_str = SQL['list_books']
             display_all_books(query_str)
             break  # out of while loop
 
@@ -741,10 +751,7 @@ def search_book_title(input_search):
 
     search_title = '%' + input_search + '%'
     # Search and display the results
-    query_str = '''SELECT book.id, book.title, author.name, book.qty
-                FROM book INNER JOIN author
-                ON book.authorID = author.id
-                WHERE title LIKE ?'''
+    query_str = SQL['search_books_by_title']
     display_books_cond(query_str, search_title)
 
 
@@ -768,10 +775,7 @@ def search_book_id():
             print("Please enter a four digit number greater than 999.")
 
     # Search and display the results
-    query_str = '''SELECT book.id, book.title, author.name, book.qty
-                   FROM book INNER JOIN author
-                   ON book.authorID = author.id
-                   WHERE book.id = ?'''
+    query_str = SQL['book_summary_by_id']
     display_books_cond(query_str, search_id)
 
 
@@ -782,10 +786,7 @@ def search_author(input_search):
     search_name = '%' + input_search + '%'
 
     # Search and display the results
-    query_str = '''SELECT book.id, book.title, author.name, book.qty
-                   FROM book INNER JOIN author
-                   ON book.authorID = author.id
-                   WHERE author.name LIKE ?'''
+    query_str = SQL['search_books_by_author_name']
     display_books_cond(query_str, search_name)
 
 
@@ -817,9 +818,9 @@ def detail(item):
     This function displays the details of an individual book in the
     required format. It is called by view_details().
     '''
-    detail_str = f"\nTitle: {item[0]}"
-    detail_str += f"\nAuthor\'s Name: {item[1]}"
-    detail_str += f"\nAuthor\'s Country: {item[2]}"
+    detail_str = f"\nTitle: {item.title}"
+    detail_str += f"\nAuthor\'s Name: {item.author_name}"
+    detail_str += f"\nAuthor\'s Country: {item.country}"
     detail_str += "\n-----------------------------------------------------"
     return detail_str
 
@@ -836,32 +837,60 @@ def view_details():
     print(header)
 
     # Get the detail information and display to screen
-    cursor = db.cursor()
-    cursor.execute('''
-                   SELECT book.title, author.name, author.country
-                   FROM book INNER JOIN author
-                   ON book.authorID = author.id
-                   ''')
-    detail_list = cursor.fetchall()
-    for item in detail_list:
+    for item in fetch_records(db, SQL['book_details'], (), BookWithAuthor):
         print(detail(item))
 
 
 # =========================================================================
 # === Main program ===
 
-# Connect database
-db = sqlite3.connect('ebookstore.db')
+# The menu only runs when this file is the main program. Worker
+# processes started by a parallel import import this module, and must
+# not run the menu again.
+if __name__ == '__main__':
+    # Connect database. Set SHELF_METRICS to a file path (.json or .prom) to
+    # record query latency, rows and commits for each menu operation.
+    metrics_path = os.environ.get('SHELF_METRICS')
+    if metrics_path:
+        metrics = shelf_metrics.QueryMetrics()
+        db = metrics.connect('ebookstore.db')
+    else:
+        metrics = None
+        db = sqlite3.connect('ebookstore.db')
 
-# Create cursor object
-cursor = db.cursor()
+    # Set SHELF_PROFILE to a directory to save a cProfile and tracemalloc
+    # report for each operation, and a summary table on exit.
+    profile_dir = os.environ.get('SHELF_PROFILE')
+    profiler = shelf_profile.Profiler(profile_dir) if profile_dir else None
 
-prepare_ebookstore_db(cursor)
+    # Create cursor object
+    cursor = db.cursor()
 
-# === Main Menu ===
-while True:
-    menu = int(input(
-        '''============= Main Menu ============
+    with shelf_metrics.track(metrics, 'prepare_ebookstore_db'):
+        prepare_ebookstore_db(cursor)
+
+    # Author and title autocomplete. The menu's writes update it in place.
+    catalog_index = PrefixIndex(db)
+    # Near-duplicate checks for new titles and author names, also
+    # updated in place by the menu's writes
+    title_checker = CatalogChecker(db, TITLE)
+    author_checker = CatalogChecker(db, AUTHOR)
+
+    # Operation names used by the query metrics and the profiler for each
+    # main menu option
+    menu_operations = {
+        1: 'enter_book',
+        2: 'update_book',
+        3: 'delete_book',
+        4: 'search_book',
+        5: 'view_details',
+        6: 'export_books_to_file',
+        }
+
+    # === Main Menu ===
+    while True:
+        menu = int(input(
+            '''============= Main Menu ============
 Select one of the following options:
     1 - Enter book
     2 - Update book
@@ -871,38 +900,44 @@ Select one of the following options:
     6 - Export books to file
     0 - Exit
 '''
-    ))
-
-    if menu == 1:
-        enter_book()
-
-    elif menu == 2:
-        update_book()
-
-    elif menu == 3:
-        delete_book()
-
-    elif menu == 4:
-        search_book()
+        ))
+
+        with shelf_metrics.track(metrics, menu_operations.get(menu, 'menu')), \
+                shelf_profile.track(profiler, menu_operations.get(menu)):
+            if menu == 1:
+                enter_book()
+
+            elif menu == 2:
+                update_book()
+
+            elif menu == 3:
+                delete_book()
+
+            elif menu == 4:
+                search_book()
+
+            elif menu == 5:
+                view_details()
+
+            elif menu == 6:
+                export_path = input("Enter the filepath to save books "
+                                    "(e.g., my_books.txt): ")
+                export_books_to_file(cursor, export_path)
+
+            elif menu == 0:
+                # Close database
+                db.commit()  # Just in case there are any uncommitted changes
+                db.close()
+                if metrics is not None:
+                    metrics.write(metrics_path)
+                if profiler is not None:
+                    profiler.write_summary()
+                print("Database disconnected.\n")
+                print("Goodbye!")
+                exit()
 
-    elif menu == 5:
-        view_details()
-
-    elif menu == 6:
-        export_path = input("Enter the filepath to save books "
-                            "(e.g., my_books.txt): ")
-        export_books_to_file(cursor, export_path)
-
-    elif menu == 0:
-        # Close database
-        db.commit()  # Just in case there are any uncommitted changes
-        db.close()
-        print("Database disconnected.\n")
-        print("Goodbye!")
-        exit()
-
-    else:
-        print("You have entered an invalid input. Please try again.")
+            else:
+                print("You have entered an invalid input. Please try again.")
 
 # ==========================================================================
 #